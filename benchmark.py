@@ -0,0 +1,454 @@
+# coding: utf-8
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from time import monotonic, perf_counter
+
+from discord import Intents
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+
+from fallout import (
+    DISCORD_OPERATOR,
+    FALLOUT_URL,
+    MODELS,
+    Cache,
+    Dice,
+    Fallout,
+    Job,
+    User,
+    UserRecord,
+    check_database,
+    db,
+    json_loads,
+    upgrade_database,
+)
+from stub import read_trace
+
+# Backend calls made by the bot and the fields they actually read
+PAYLOADS = (
+    ("get_user", "character/{character}/", ("id", "name", "campaign_id")),
+    ("get_channel", "campaign/{campaign}/", ("current_game_date",)),
+    ("get_character_url", "common/token/?user_id={player}&page=1&page_size=1", ("key",)),
+)
+
+# Tables of the first release, before any migration
+BASELINE_SCHEMA = (
+    'CREATE TABLE "channel" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "topic" TEXT, '
+    '"campaign_id" INTEGER, "date" DATETIME)',
+    'CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "level" INTEGER NOT NULL, '
+    '"player_id" INTEGER, "character_id" INTEGER, "my_channel_id" INTEGER, "channel_id" INTEGER, '
+    'FOREIGN KEY ("channel_id") REFERENCES "channel" ("id"))',
+    'CREATE INDEX "user_channel_id" ON "user" ("channel_id")',
+    "INSERT INTO \"channel\" VALUES (1, 'la-ville', NULL, 1, NULL)",
+    "INSERT INTO \"user\" VALUES (2, 'joueur', 1, 3, 4, NULL, 1)",
+)
+
+
+def user_model(index):
+    return User(
+        id=10**17 + index,
+        guild_id=10**17,
+        name=f"Joueur {index}",
+        level=1,
+        player_id=index,
+        character_id=index,
+        my_channel_id=10**17 + index,
+        channel=10**17,
+    )
+
+
+def user_record(index):
+    return UserRecord(
+        id=10**17 + index,
+        name=f"Joueur {index}",
+        level=1,
+        player_id=index,
+        character_id=index,
+        my_channel_id=10**17 + index,
+        channel_id=10**17,
+        guild_id=10**17,
+    )
+
+
+def measure(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    cache = Cache(maxsize=count)
+    for index in range(count):
+        cache[index] = factory(index)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cache
+    return size
+
+
+def memory(args):
+    print(f"{'cache':>8} {'entries':>8} {'total':>12} {'per entry':>10}")
+    for count in args.counts:
+        for label, factory in (("model", user_model), ("record", user_record)):
+            size = measure(factory, count)
+            print(f"{label:>8} {count:>8} {size / 2**20:>8.1f} MiB {size / count:>8.0f} B")
+
+
+def startup(args):
+    if not os.environ.get("DISCORD_TOKEN"):
+        sys.exit("DISCORD_TOKEN is required to measure startup")
+    print(f"{'mode':>8} {'ready':>8} {'peak RSS':>12}")
+    for label, value in (("full", "0"), ("low", "1")):
+        env = dict(os.environ, DISCORD_LOW_FOOTPRINT=value)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fallout.py")
+        process = subprocess.Popen([sys.executable, script], env=env, stderr=subprocess.PIPE, text=True)
+        try:
+            for line in process.stderr:
+                if match := re.search(r"Ready in ([\d.]+)s \(peak RSS ([\d.]+) MiB\)", line):
+                    print(f"{label:>8} {float(match[1]):>7.2f}s {float(match[2]):>8.1f} MiB")
+                    break
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def summary(results):
+    results = sorted(results)
+    quartiles = " / ".join(str(results[len(results) * q // 4]) for q in (1, 2, 3))
+    return f"mean {sum(results) / len(results):>6.2f}  quartiles {quartiles}"
+
+
+async def compare_odds(args):
+    # Backend outcomes are sampled with simulated damages and rolls without experience
+    cog = Fallout(None)
+    character = await cog.request(f"character/{args.character}/")
+    if not character:
+        sys.exit(f"Character {args.character} not found")
+    dice = Dice(character)
+    min_damage, max_damage, raw_damage = args.damage
+    local = dice.damage(min_damage, max_damage, raw_damage, damage_type=args.type, trials=args.trials)
+    remote = []
+    data = dict(min_damage=min_damage, max_damage=max_damage, raw_damage=raw_damage, damage_type=args.type)
+    for _ in range(args.samples):
+        ret = await cog.request(f"character/{args.character}/damage/", method="post", data=dict(data, simulation=True))
+        remote.append(character["health"] - ret["character"]["health"])
+    print(f"damage   local   {summary(local)}")
+    print(f"damage   backend {summary(remote)}")
+    if args.stats:
+        scale = 10 if args.stats in Fallout.SPECIAL_ORDER else 1
+        ret = dice.roll(args.stats, scale=scale, trials=args.trials)
+        print(f"roll     local   success {ret['success']:.1%}  critical {ret['critical_success']:.1%}")
+        rolls = [
+            await cog.request(f"character/{args.character}/roll/", method="post", data=dict(stats=args.stats, xp=False))
+            for _ in range(args.samples)
+        ]
+        success = sum(bool(r["success"]) for r in rolls) / len(rolls)
+        critical = sum(bool(r["success"] and r["critical"]) for r in rolls) / len(rolls)
+        print(f"roll     backend success {success:.1%}  critical {critical:.1%}")
+
+
+def odds(args):
+    asyncio.run(compare_odds(args))
+
+
+def decode_time(loads, content, repeat):
+    started = perf_counter()
+    for _ in range(repeat):
+        loads(content)
+    return (perf_counter() - started) / repeat
+
+
+async def compare_payloads(args):
+    cog = Fallout(None)
+    decoders = [("json", json.loads)] + ([("orjson", json_loads)] if json_loads is not json.loads else [])
+    print(f"{'call':>18} {'fields':>8} {'bytes':>8} " + " ".join(f"{name:>10}" for name, loads in decoders))
+    for label, endpoint, fields in PAYLOADS:
+        endpoint = endpoint.format(**vars(args))
+        if "None" in endpoint:
+            continue
+        separator = "&" if "?" in endpoint else "?"
+        for variant, path in (("all", endpoint), ("trimmed", f"{endpoint}{separator}fields={','.join(fields)}")):
+            resp = await cog.session.get("/".join([FALLOUT_URL, "api", path]))
+            timings = " ".join(
+                f"{decode_time(loads, resp.content, args.repeat) * 1e6:>7.1f} µs" for name, loads in decoders
+            )
+            print(f"{label:>18} {variant:>8} {len(resp.content):>8} {timings}")
+
+
+def payload(args):
+    asyncio.run(compare_payloads(args))
+
+
+# Discord is replaced by the few objects used by the commands, anything sent is discarded
+IDENTIFIERS = itertools.count(10**6)
+
+
+class ReplayRole:
+
+    def __init__(self, name):
+        self.id, self.name = next(IDENTIFIERS), name
+
+
+class ReplayMessage:
+
+    def __init__(self, channel, author=None, content=None):
+        self.id, self.channel, self.author, self.content = next(IDENTIFIERS), channel, author, content
+        self.guild = getattr(channel, "guild", None)
+        self._state = None
+
+    async def delete(self, **options):
+        pass
+
+    async def edit(self, **options):
+        pass
+
+
+class ReplayMember:
+
+    def __init__(self, guild, id, name, roles):
+        self.guild, self.id, self.name, self.roles = guild, id, name, roles
+        self.nick = self.global_name = None
+        self.display_name = name
+        self.mention = f"<@{id}>"
+        self.bot = False
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def send(self, content=None, **options):
+        return ReplayMessage(None, content=content)
+
+
+class ReplayChannel:
+
+    def __init__(self, guild, id, name, topic=None, category=None, overwrites=None):
+        self.guild, self.id, self.name, self.topic, self.category = guild, id, name, topic, category
+        self.category_id = getattr(category, "id", None)
+        self.overwrites = overwrites or {}
+        self._overwrites = []
+        self.last_message_id = None
+        self.mention = f"<#{id}>"
+
+    @property
+    def members(self):
+        return list(self.guild.members)
+
+    async def send(self, content=None, **options):
+        return ReplayMessage(self, content=content)
+
+    async def edit(self, **options):
+        for name, value in options.items():
+            setattr(self, name, value)
+
+    async def set_permissions(self, target, **options):
+        pass
+
+    async def purge(self, **options):
+        return []
+
+
+class ReplayGuild:
+
+    def __init__(self, id):
+        self.id, self.name = id, f"guild-{id}"
+        self.roles, self.users, self.text_channels = [], {}, {}
+        self.default_role = self.role("@everyone")
+
+    @property
+    def channels(self):
+        return list(self.text_channels.values())
+
+    @property
+    def members(self):
+        return list(self.users.values())
+
+    def role(self, name):
+        if not (role := next((role for role in self.roles if role.name == name), None)):
+            role = ReplayRole(name)
+            self.roles.append(role)
+        return role
+
+    def member(self, data):
+        if data["id"] not in self.users:
+            roles = [self.role(name) for name in data["roles"]]
+            self.users[data["id"]] = ReplayMember(self, data["id"], data["name"], roles)
+        return self.users[data["id"]]
+
+    def channel(self, data):
+        if data["id"] not in self.text_channels:
+            self.text_channels[data["id"]] = ReplayChannel(self, data["id"], data["name"])
+        return self.text_channels[data["id"]]
+
+    def get_member(self, member_id):
+        return self.users.get(member_id)
+
+    async def fetch_member(self, member_id):
+        return self.users.get(member_id)
+
+    async def query_members(self, query=None, user_ids=None, limit=1):
+        return []
+
+    async def create_text_channel(self, name, **options):
+        channel = ReplayChannel(self, next(IDENTIFIERS), name, **options)
+        self.text_channels[channel.id] = channel
+        return channel
+
+
+class ReplayBot(commands.Bot):
+
+    def __init__(self):
+        super().__init__(command_prefix=DISCORD_OPERATOR, intents=Intents.none())
+        self.replay_guilds = {}
+        self.errors = defaultdict(int)
+        self.add_listener(self.count_error, "on_command_error")
+
+    async def count_error(self, ctx, error):
+        self.errors[ctx.command.name] += 1
+
+    @property
+    def guilds(self):
+        return list(self.replay_guilds.values())
+
+    def get_guild(self, guild_id):
+        return self.replay_guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        return next((g.text_channels[channel_id] for g in self.guilds if channel_id in g.text_channels), None)
+
+    def get_user(self, user_id):
+        return next((g.users[user_id] for g in self.guilds if user_id in g.users), None)
+
+    def get_all_members(self):
+        return itertools.chain.from_iterable(guild.members for guild in self.guilds)
+
+    def prepare(self, entry):
+        # Guilds, members and channels of the whole trace exist from the start, as they would on Discord
+        if entry["guild"] not in self.replay_guilds:
+            self.replay_guilds[entry["guild"]] = ReplayGuild(entry["guild"])
+        guild = self.replay_guilds[entry["guild"]]
+        for member in entry.get("members", ()):
+            guild.member(member)
+        return ReplayMessage(guild.channel(entry["channel"]), guild.member(entry["author"]), entry["content"])
+
+    async def replay(self, message):
+        # Slash commands are recorded with the text command they run
+        prefix = "/" if message.content.startswith("/") else DISCORD_OPERATOR
+        view = StringView(message.content)
+        view.skip_string(prefix)
+        ctx = commands.Context(prefix=prefix, view=view, bot=self, message=message)
+        ctx.invoked_with = view.get_word()
+        ctx.command = self.all_commands.get(ctx.invoked_with)
+        started = perf_counter()
+        await self.invoke(ctx)
+        return ctx.invoked_with, perf_counter() - started
+
+
+async def replay_trace(args):
+    # Commands are replayed on a fresh database against a stub serving the recorded responses (stub.py --trace)
+    db.init(os.path.join(tempfile.mkdtemp(), "replay.db"))
+    upgrade_database()
+    entries = [entry for entry in read_trace(args.trace) if entry["type"] == "command"]
+    bot = ReplayBot()
+    messages = [bot.prepare(entry) for entry in entries]
+    cog = Fallout(bot)
+    cog.recorder = None
+    requests = itertools.count()
+
+    async def count_request(request):
+        next(requests)
+
+    cog.session.event_hooks["request"] = [count_request]
+    bot.add_cog(cog)
+    await cog.on_ready()
+    started, tasks = monotonic(), []
+    for entry, message in zip(entries, messages):
+        await asyncio.sleep(max(entry["time"] / args.speed - (monotonic() - started), 0))
+        tasks.append(asyncio.create_task(bot.replay(message)))
+    results = defaultdict(list)
+    for name, elapsed in await asyncio.gather(*tasks):
+        results[name].append(elapsed * 1000)
+    # Jobs and background tasks started by the commands are part of the load
+    background = lambda: any(task and not task.done() for task in (cog.provisioner, cog.outbox))
+    while background() or Job.select().where(Job.state.in_(("pending", "running"))).exists():
+        await asyncio.sleep(0.1)
+    elapsed = monotonic() - started
+    print(f"{'command':>10} {'count':>6} {'errors':>6} {'mean':>8} {'p50':>8} {'p95':>8}")
+    for name, timings in sorted(results.items()):
+        timings.sort()
+        p50, p95 = timings[len(timings) // 2], timings[len(timings) * 95 // 100]
+        mean = sum(timings) / len(timings)
+        errors = bot.errors[name]
+        print(f"{name:>10} {len(timings):>6} {errors:>6} {mean:>5.0f} ms {p50:>5.0f} ms {p95:>5.0f} ms")
+    print(f"{len(entries)} commands and {next(requests)} backend requests in {elapsed:.1f}s")
+
+
+def replay(args):
+    asyncio.run(replay_trace(args))
+
+
+def upgrade(args):
+    # A database created by the first release is migrated, then compared with the current models
+    db.init(os.path.join(tempfile.mkdtemp(), "upgrade.db"))
+    for sql in BASELINE_SCHEMA:
+        db.execute_sql(sql)
+    started = perf_counter()
+    upgrade_database()
+    print(f"Upgraded in {(perf_counter() - started) * 1000:.0f} ms")
+    check_database()
+    errors = []
+    for model in MODELS:
+        table = model._meta.table_name
+        columns = {column.name for column in db.get_columns(table)}
+        indexes = [index.columns for index in db.get_indexes(table)]
+        for field in model._meta.sorted_fields:
+            if field.column_name not in columns:
+                errors.append(f"{table}.{field.column_name} is missing")
+            elif field.index and not field.primary_key and [field.column_name] not in indexes:
+                errors.append(f"{table}.{field.column_name} is not indexed")
+    for error in errors:
+        print(error)
+    if errors:
+        sys.exit(1)
+    print(f"{len(MODELS)} tables match the models")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fallout bot benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    subparser = subparsers.add_parser("memory", help="Memory footprint of the user cache")
+    subparser.add_argument("--counts", type=int, nargs="+", default=[10_000, 100_000], help="Number of cached users")
+    subparser.set_defaults(func=memory)
+    subparser = subparsers.add_parser("startup", help="Startup time and memory in full and low footprint modes")
+    subparser.set_defaults(func=startup)
+    subparser = subparsers.add_parser("odds", help="Compare the local dice engine with the backend outcomes")
+    subparser.add_argument("character", type=int, help="Character identifier")
+    subparser.add_argument("--damage", type=int, nargs=3, default=[5, 15, 0], metavar=("MIN", "MAX", "RAW"))
+    subparser.add_argument("--type", default="normal", help="Damage type")
+    subparser.add_argument("--stats", help="Also compare rolls for this statistic (logged by the backend)")
+    subparser.add_argument("--samples", type=int, default=200, help="Number of backend calls")
+    subparser.add_argument("--trials", type=int, default=100_000, help="Number of local trials")
+    subparser.set_defaults(func=odds)
+    subparser = subparsers.add_parser("payload", help="Response sizes and decode times with and without fields")
+    subparser.add_argument("--character", type=int, help="Character identifier")
+    subparser.add_argument("--campaign", type=int, help="Campaign identifier")
+    subparser.add_argument("--player", type=int, help="Player identifier")
+    subparser.add_argument("--repeat", type=int, default=1000, help="Number of decodes per response")
+    subparser.set_defaults(func=payload)
+    subparser = subparsers.add_parser("replay", help="Replay a trace recorded with FALLOUT_RECORD")
+    subparser.add_argument("trace", help="Trace file")
+    subparser.add_argument("--speed", type=float, default=1, help="Speed factor, also to be given to stub.py")
+    subparser.set_defaults(func=replay)
+    subparser = subparsers.add_parser("upgrade", help="Upgrade a database created by the first release")
+    subparser.set_defaults(func=upgrade)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,49 @@
 import argparse
 import asyncio
 
+import contextvars
+import gzip
 import httpx
+import importlib
 import io
+import itertools
+import json
 import locale
 import logging
 import os
 import peewee as pw
+import random
 import re
+import resource
+import subprocess
+import sys
 import uuid
-from dataclasses import dataclass
+from collections import deque, OrderedDict
+from contextlib import aclosing, asynccontextmanager, AsyncExitStack
 from datetime import datetime, timedelta
-from dateutil.parser import parse as parse_date
-from discord import utils, Colour, File, Intents
+from functools import cache
+from time import monotonic
+from discord import (
+    utils,
+    guild_only,
+    slash_command,
+    ApplicationContext,
+    CategoryChannel,
+    Colour,
+    File,
+    HTTPException,
+    Intents,
+    MemberCacheFlags,
+    NotFound,
+    Object,
+    Option,
+    PermissionOverwrite,
+    Permissions,
+)
 from discord.embeds import Embed
 from discord.ext import commands
-import chat_exporter
+from discord.ext.commands.view import StringView
+from playhouse.migrate import SqliteMigrator, migrate
 
 
 DISCORD_TOKEN = os.environ.get("DISCORD_TOKEN")
@@ -26,12 +54,43 @@ DISCORD_ADMIN_ROLE = os.environ.get("DISCORD_ROLE") or "MJ"
 DISCORD_PLAYER_ROLE = os.environ.get("DISCORD_PLAYER") or "PJ"
 DISCORD_CATEGORY = os.environ.get("DISCORD_CATEGORY") or "Joueurs"
 DISCORD_WORLD = os.environ.get("DISCORD_WORLD") or "Monde"
+DISCORD_SHARDS = os.environ.get("DISCORD_SHARDS")
+DISCORD_LOW_FOOTPRINT = (os.environ.get("DISCORD_LOW_FOOTPRINT") or "").lower() in ("1", "true", "yes")
 FALLOUT_TOKEN = os.environ.get("FALLOUT_TOKEN")
 FALLOUT_URL = os.environ.get("FALLOUT_URL")
-FALLOUT_DATE = parse_date(os.environ.get("FALLOUT_DATE") or datetime.now().isoformat(), dayfirst=True)
+FALLOUT_DATE = os.environ.get("FALLOUT_DATE")
 FALLOUT_CAMPAIGN = int(os.environ.get("FALLOUT_CAMPAIGN") or 0) or None
+FALLOUT_EVENTS = os.environ.get("FALLOUT_EVENTS")
+FALLOUT_EVENTS_RETRY = float(os.environ.get("FALLOUT_EVENTS_RETRY") or 10)
+FALLOUT_CACHE_TTL = float(os.environ.get("FALLOUT_CACHE_TTL") or 3600)
+FALLOUT_MAX_TRIALS = int(os.environ.get("FALLOUT_MAX_TRIALS") or 100000)
+FALLOUT_BACKGROUND_RATE = float(os.environ.get("FALLOUT_BACKGROUND_RATE") or 5)
+FALLOUT_PROVISION_BATCH = int(os.environ.get("FALLOUT_PROVISION_BATCH") or 20)
+FALLOUT_PROVISION_CONCURRENCY = int(os.environ.get("FALLOUT_PROVISION_CONCURRENCY") or 4)
+FALLOUT_PROVISION_RETRIES = int(os.environ.get("FALLOUT_PROVISION_RETRIES") or 3)
+FALLOUT_RENAME_DELAY = float(os.environ.get("FALLOUT_RENAME_DELAY") or 5)
+FALLOUT_CACHE_SIZE = int(os.environ.get("FALLOUT_CACHE_SIZE") or 10000)
+FALLOUT_DATABASE = os.environ.get("FALLOUT_DATABASE") or "fallout.db"
+FALLOUT_STORE = os.environ.get("FALLOUT_STORE") or "local"
+FALLOUT_SYNC_INTERVAL = float(os.environ.get("FALLOUT_SYNC_INTERVAL") or 2)
+FALLOUT_SYNC_RETENTION = float(os.environ.get("FALLOUT_SYNC_RETENTION") or 3600)
+FALLOUT_JOB_WORKERS = int(os.environ.get("FALLOUT_JOB_WORKERS") or 2)
+FALLOUT_JOB_TIMEOUT = float(os.environ.get("FALLOUT_JOB_TIMEOUT") or 300)
+FALLOUT_CONCURRENCY = int(os.environ.get("FALLOUT_CONCURRENCY") or 8)
+FALLOUT_MAX_CONCURRENCY = int(os.environ.get("FALLOUT_MAX_CONCURRENCY") or 64)
+FALLOUT_TARGET_LATENCY = float(os.environ.get("FALLOUT_TARGET_LATENCY") or 1)
+FALLOUT_OUTAGE_DELAY = float(os.environ.get("FALLOUT_OUTAGE_DELAY") or 30)
+FALLOUT_RECORD = os.environ.get("FALLOUT_RECORD")
+FALLOUT_PAGE_SIZE = int(os.environ.get("FALLOUT_PAGE_SIZE") or 100)
+
+# Discord only allows a channel to be renamed twice every ten minutes
+DISCORD_RENAME_LIMIT, DISCORD_RENAME_PERIOD = 2, 600
 
 REGEX_FLAGS = re.IGNORECASE | re.MULTILINE
+TARGETS_HELP = "Nom du joueur, identifiant du personnage, @escouade ou #salon"
+
+# Discord limits the number and total size of embeds in a single message
+DISCORD_EMBED_LIMIT, DISCORD_EMBED_SIZE = 10, 6000
 
 log_handler = logging.StreamHandler()
 log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)7s: %(message)s"))
@@ -44,40 +103,411 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(log_handler)
 
-db = pw.SqliteDatabase("fallout.db")
+
+class LazyModule:
+
+    def __init__(self, name):
+        self.name, self.module = name, None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+# Heavy dependencies only needed by a few commands are imported on first use
+chat_exporter = LazyModule("chat_exporter")
+dateutil_parser = LazyModule("dateutil.parser")
+LAZY_MODULES = (chat_exporter, dateutil_parser)
+
+# Backend responses are decoded with orjson when it is installed
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def parse_date(value, **options):
+    return dateutil_parser.parse(value, **options)
+
+
+@cache
+def get_start_date():
+    return parse_date(FALLOUT_DATE, dayfirst=True) if FALLOUT_DATE else datetime.now()
+
+
+# WAL allows several bot processes to read the database while one of them is writing
+db = pw.SqliteDatabase(FALLOUT_DATABASE, pragmas={"journal_mode": "wal", "busy_timeout": 5000})
 
 
 class Channel(pw.Model):
     id = pw.BigIntegerField(primary_key=True)
     name = pw.CharField()
     topic = pw.TextField(null=True)
-    campaign_id = pw.IntegerField(null=True)
+    campaign_id = pw.IntegerField(null=True, index=True)
     date = pw.DateTimeField(null=True)
+    purged_id = pw.BigIntegerField(null=True)
+    guild_id = pw.BigIntegerField(null=True, index=True)
 
     class Meta:
         database = db
 
 
 class User(pw.Model):
-    id = pw.BigIntegerField(primary_key=True)
+    id = pw.BigIntegerField(index=True)
+    guild_id = pw.BigIntegerField()
     name = pw.CharField()
     level = pw.IntegerField(default=0)
     player_id = pw.IntegerField(null=True)
-    character_id = pw.IntegerField(null=True)
+    character_id = pw.IntegerField(null=True, index=True)
     my_channel_id = pw.BigIntegerField(null=True)
     channel = pw.ForeignKeyField(Channel, null=True)
 
     class Meta:
         database = db
+        primary_key = pw.CompositeKey("guild_id", "id")
+
+
+class Guild(pw.Model):
+    id = pw.BigIntegerField(primary_key=True)
+    name = pw.CharField()
+    admin_role = pw.CharField(default=DISCORD_ADMIN_ROLE)
+    player_role = pw.CharField(default=DISCORD_PLAYER_ROLE)
+    category = pw.CharField(default=DISCORD_CATEGORY)
+    world = pw.CharField(default=DISCORD_WORLD)
+    campaign_id = pw.IntegerField(null=True, default=FALLOUT_CAMPAIGN)
+
+    class Meta:
+        database = db
+
+
+class Creature(pw.Model):
+    character_id = pw.IntegerField(primary_key=True)
+    name = pw.CharField()
+    campaign_id = pw.IntegerField(null=True)
+    guild_id = pw.BigIntegerField(null=True)
+    squad = pw.CharField(null=True)
+
+    class Meta:
+        database = db
+        indexes = ((("guild_id", "squad"), False),)
+
+
+class Change(pw.Model):
+    model = pw.CharField()
+    key = pw.BigIntegerField()
+    process = pw.CharField()
+    date = pw.DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        database = db
+
+
+class Job(pw.Model):
+    kind = pw.CharField()
+    label = pw.CharField()
+    data = pw.TextField()
+    position = pw.IntegerField(default=0)
+    state = pw.CharField(default="pending", index=True)
+    author_id = pw.BigIntegerField(null=True)
+    error = pw.TextField(null=True)
+    date = pw.DateTimeField(default=datetime.now)
+    updated = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+
+class Outbox(pw.Model):
+    endpoint = pw.CharField()
+    method = pw.CharField()
+    data = pw.TextField()
+    attempts = pw.IntegerField(default=0)
+    date = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+
+class Migration(pw.Model):
+    id = pw.IntegerField(primary_key=True)
+    name = pw.CharField()
+    date = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+
+MODELS = (Channel, User, Guild, Creature, Change, Job, Outbox, Migration)
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def add_index(migrator, model, *columns):
+    table = model._meta.table_name
+    if not any(index.columns == list(columns) for index in db.get_indexes(table)):
+        migrate(migrator.add_index(table, columns))
+
+
+def add_column(migrator, model, name):
+    table = model._meta.table_name
+    if not any(column.name == name for column in db.get_columns(table)):
+        migrate(migrator.add_column(table, name, model._meta.fields[name]))
+
+
+@migration
+def add_lookup_indexes(migrator):
+    add_index(migrator, User, "channel_id")
+    add_index(migrator, User, "character_id")
+    add_index(migrator, Channel, "campaign_id")
+
+
+@migration
+def add_guild_table(migrator):
+    db.create_tables([Guild])
+
+
+@migration
+def add_shared_state_tables(migrator):
+    db.create_tables([Creature, Change])
+
+
+@migration
+def add_job_table(migrator):
+    db.create_tables([Job])
+
+
+@migration
+def add_channel_purged_id(migrator):
+    add_column(migrator, Channel, "purged_id")
+
+
+@migration
+def add_outbox_table(migrator):
+    db.create_tables([Outbox])
+
+
+@migration
+def add_channel_guild_id(migrator):
+    add_column(migrator, Channel, "guild_id")
+    add_index(migrator, Channel, "guild_id")
+
+
+@migration
+def partition_users_by_guild(migrator):
+    # Primary keys cannot be altered, the table is rebuilt and its users are assigned to their guild on startup
+    db.execute_sql('ALTER TABLE "user" RENAME TO "user_old"')
+    for index in db.get_indexes("user_old"):
+        if index.sql:
+            db.execute_sql(f'DROP INDEX "{index.name}"')
+    db.create_tables([User])
+    columns = ", ".join(f'"{column.name}"' for column in db.get_columns("user_old"))
+    db.execute_sql(f'INSERT INTO "user" ("guild_id", {columns}) SELECT 0, {columns} FROM "user_old"')
+    db.execute_sql('DROP TABLE "user_old"')
+
+
+def upgrade_database():
+    # Tables created from scratch already match the models, migrations are only applied to older databases
+    # Older tables are left to the migrations, indexes on columns they add could not be created before them
+    created = not db.table_exists(User)
+    db.create_tables(MODELS if created else [Migration])
+    applied = {m.id for m in Migration.select(Migration.id)}
+    migrator = SqliteMigrator(db)
+    for version, func in enumerate(MIGRATIONS, start=1):
+        if version in applied:
+            continue
+        with db.atomic():
+            if not created:
+                logger.info(f"Applying migration #{version} ({func.__name__})")
+                func(migrator)
+            Migration.create(id=version, name=func.__name__)
+
+
+def check_database():
+    queries = (
+        User.select().where(User.channel == 0),
+        User.select().where(User.character_id == 0),
+        Channel.select().where(Channel.campaign_id == 0),
+    )
+    for query in queries:
+        sql, params = query.sql()
+        plan = db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        if not any("INDEX" in row[-1] for row in plan):
+            logger.warning(f"Query is not backed by an index: {sql}")
+
+
+class LocalStore:
+    # State is only used by the current process, nothing has to be shared
+    shared = False
+
+    def publish(self, model, key):
+        pass
+
+    def poll(self):
+        return []
+
+
+class SqliteStore(LocalStore):
+    # Changes are logged in the database and polled by the other processes to invalidate their caches
+    shared = True
+
+    def __init__(self):
+        self.process = uuid.uuid4().hex
+        self.last_id = None
+        self.pruned = monotonic()
+
+    def publish(self, model, key):
+        Change.create(model=model._meta.table_name, key=key, process=self.process)
+
+    def poll(self):
+        if self.last_id is None:
+            self.last_id = Change.select(pw.fn.MAX(Change.id)).scalar() or 0
+            return []
+        changes = list(Change.select().where(Change.id > self.last_id).order_by(Change.id))
+        if changes:
+            self.last_id = changes[-1].id
+        if monotonic() - self.pruned > FALLOUT_SYNC_RETENTION:
+            Change.delete().where(Change.date < datetime.now() - timedelta(seconds=FALLOUT_SYNC_RETENTION)).execute()
+            self.pruned = monotonic()
+        return [(change.model, change.key) for change in changes if change.process != self.process]
+
+
+STORES = {"local": LocalStore, "sqlite": SqliteStore}
+store = STORES[FALLOUT_STORE]()
+
+
+class Record:
+    __slots__ = ()
+    model = None
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def load(cls, instance, **fields):
+        return cls(**{name: getattr(instance, name, None) for name in cls.__slots__} | fields)
+
+    def save(self, *fields):
+        key = self.model._meta.primary_key
+        # Changes to records with a composite key are published with its last field
+        names = key.field_names if isinstance(key, pw.CompositeKey) else (key.name,)
+        self.model.update(**{name: getattr(self, name) for name in fields}).where(
+            *(getattr(self.model, name) == getattr(self, name) for name in names)
+        ).execute()
+        store.publish(self.model, getattr(self, names[-1]))
+
+
+class UserRecord(Record):
+    __slots__ = ("id", "name", "level", "player_id", "character_id", "my_channel_id", "channel_id", "guild_id")
+    model = User
+
+    @property
+    def key(self):
+        return self.guild_id, self.id
+
+
+class ChannelRecord(Record):
+    __slots__ = ("id", "name", "topic", "campaign_id", "date", "purged_id", "guild_id", "refreshed")
+    model = Channel
+
+
+class GuildRecord(Record):
+    __slots__ = ("id", "name", "admin_role", "player_role", "category", "world", "campaign_id")
+    model = Guild
 
 
-@dataclass
-class Creature:
-    id: int
-    name: str
-    character_id: int
-    campaign_id: int
-    my_channel_id: int = 0
+class CreatureRecord(Record):
+    __slots__ = ("id", "name", "character_id", "campaign_id", "guild_id", "squad", "my_channel_id")
+    model = Creature
+
+
+class JobRecord(Record):
+    __slots__ = ("id", "kind", "label", "data", "position", "state", "author_id", "error", "updated", "keys", "steps")
+    model = Job
+
+    @classmethod
+    def load(cls, instance, **fields):
+        return super().load(instance, **json.loads(instance.data) | fields)
+
+    def checkpoint(self, *fields):
+        # Steps and their parameters are saved with the progress so that the job can be resumed
+        self.data = json.dumps(dict(keys=self.keys, steps=self.steps))
+        self.updated = datetime.now()
+        self.save("data", "position", "updated", *fields)
+
+
+class Cache(OrderedDict):
+
+    def __init__(self, maxsize=FALLOUT_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def normalize(name):
+    return name.lower().replace("#", "").replace(" ", "-").replace("_", "-")
+
+
+class GuildIndex:
+
+    def __init__(self, guild):
+        self.roles, self.categories, self.channels, self.names = {}, {}, {}, {}
+        for role in guild.roles:
+            self.add_role(role)
+        for channel in guild.channels:
+            self.add_channel(channel)
+
+    def add_role(self, role):
+        self.roles[role.name] = role
+
+    def remove_role(self, role):
+        if getattr(self.roles.get(role.name), "id", None) == role.id:
+            del self.roles[role.name]
+
+    def add_channel(self, channel):
+        if isinstance(channel, CategoryChannel):
+            self.categories[channel.name] = channel
+        else:
+            self.channels[channel.category_id, normalize(channel.name)] = channel
+        self.names[channel.name.lower()] = channel
+
+    def remove_channel(self, channel):
+        if isinstance(channel, CategoryChannel):
+            keys = ((self.categories, channel.name),)
+        else:
+            keys = ((self.channels, (channel.category_id, normalize(channel.name))),)
+        for mapping, key in keys + ((self.names, channel.name.lower()),):
+            if getattr(mapping.get(key), "id", None) == channel.id:
+                del mapping[key]
+
+    def get_channel(self, name, category=None):
+        return self.channels.get((category.id if category else None, normalize(name)))
+
+
+class Parsed(Exception):
+    pass
+
+
+# Set while batch lines are parsed without being run, the parsed arguments are then raised with Parsed
+dry_run = contextvars.ContextVar("dry_run", default=False)
 
 
 class Parser(argparse.ArgumentParser):
@@ -88,6 +518,8 @@ class Parser(argparse.ArgumentParser):
 
     def parse_args(self, args=None, namespace=None):
         result = self.parse_known_args(args, namespace)
+        if dry_run.get():
+            raise Parsed(None if self.message else result[0])
         if self.message:
             return
         args, argv = result
@@ -107,6 +539,324 @@ class Parser(argparse.ArgumentParser):
         pass
 
 
+def get_overwrites(channel):
+    # Members are not necessarily cached, their overwrites are kept by identifier
+    overwrites = {}
+    for overwrite in channel._overwrites:
+        target = channel.guild.get_role(overwrite.id) if overwrite.is_role() else Object(id=overwrite.id)
+        if target:
+            allow, deny = Permissions(overwrite.allow), Permissions(overwrite.deny)
+            overwrites[target] = PermissionOverwrite.from_pair(allow, deny)
+    return overwrites
+
+
+def split_arguments(text):
+    # Arguments are split the same way as text commands, with double quotes around spaces
+    view, arguments = StringView(text.strip()), []
+    while not view.eof:
+        arguments.append(view.get_quoted_word())
+        view.skip_ws()
+    return arguments
+
+
+def quote(argument):
+    return f'"{argument}"' if " " in argument else argument
+
+
+def to_arguments(*args, **options):
+    # Converts slash command options into the arguments of the matching text command
+    arguments = [str(arg) for arg in args]
+    for name, value in options.items():
+        if value is None or value is False or value == "":
+            continue
+        arguments.append(f"--{name}")
+        if isinstance(value, (list, tuple)):
+            arguments.extend(map(str, value))
+        elif value is not True:
+            arguments.append(str(value))
+    return arguments
+
+
+def is_game_master():
+    # Same as commands.has_role but with the game master role configured for the guild
+    async def predicate(ctx):
+        if not ctx.guild:
+            raise commands.NoPrivateMessage()
+        if not ctx.cog.has_role(ctx.author):
+            raise commands.MissingRole(ctx.cog.get_config(ctx.guild).admin_role)
+        return True
+
+    return commands.check(predicate)
+
+
+class Locks:
+
+    def __init__(self):
+        self.locks = {}
+        self.counts = {}
+
+    @asynccontextmanager
+    async def __call__(self, *keys):
+        # Keys are acquired in a stable order to prevent deadlocks between commands sharing several keys
+        keys = sorted({key for key in keys if key[-1] is not None})
+        for key in keys:
+            self.locks.setdefault(key, asyncio.Lock())
+            self.counts[key] = self.counts.get(key, 0) + 1
+        try:
+            async with AsyncExitStack() as stack:
+                for key in keys:
+                    await stack.enter_async_context(self.locks[key])
+                yield
+        finally:
+            for key in keys:
+                self.counts[key] -= 1
+                if not self.counts[key]:
+                    del self.counts[key], self.locks[key]
+
+
+class Limiter:
+    # Concurrent requests grow by one per round trip and are halved when the backend slows down or fails
+    def __init__(self, limit=FALLOUT_CONCURRENCY, maximum=FALLOUT_MAX_CONCURRENCY, latency=FALLOUT_TARGET_LATENCY):
+        self.limit = float(limit)
+        self.maximum = maximum
+        self.latency = latency
+        self.active = 0
+        self.decreased = monotonic()
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+            return monotonic()
+
+    async def release(self, started, overloaded=False):
+        async with self.condition:
+            self.active -= 1
+            if overloaded or monotonic() - started > self.latency:
+                # Requests sent before the previous decrease do not reflect the current limit
+                if started > self.decreased:
+                    self.limit = max(self.limit / 2, 1)
+                    self.decreased = monotonic()
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self.condition.notify_all()
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class BackendError(Exception):
+    pass
+
+
+class Recorder:
+    # Discord identifiers and names are replaced by stable aliases, backend identifiers are kept
+    SECRETS = ("key", "token", "password")
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        self.started = monotonic()
+        self.aliases = {}
+        self.pattern = None
+
+    def alias(self, value, prefix=None, alias=None):
+        if value not in self.aliases:
+            self.aliases[value] = alias or (f"{prefix}-{len(self.aliases) + 1}" if prefix else len(self.aliases) + 1)
+            if isinstance(value, str):
+                names = sorted((key for key in self.aliases if isinstance(key, str)), key=len, reverse=True)
+                self.pattern = re.compile(rf"\b(?:{'|'.join(map(re.escape, names))})\b", re.IGNORECASE)
+        return self.aliases[value]
+
+    def alias_member(self, member):
+        # Parts of names are aliased as well, since players are usually designated by their first name
+        alias = self.alias(member.name.lower(), "joueur")
+        for name in filter(None, (member.name, member.nick, member.display_name)):
+            for value in (name, *re.findall(r"\w{3,}", name)):
+                self.alias(value.lower(), alias=alias)
+        return alias
+
+    def anonymize(self, value):
+        if isinstance(value, dict):
+            # Names of characters and players reached through squads, channels or campaigns are not always known yet
+            for key in ("name", "nickname"):
+                if isinstance(value.get(key), str) and value[key].strip():
+                    self.alias(value[key].lower(), "nom")
+            return {key: "secret" if key in self.SECRETS else self.anonymize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item) for item in value]
+        if isinstance(value, int) and value > 10**15:
+            return self.alias(value)
+        if not isinstance(value, str):
+            return value
+        value = re.sub(r"\d{16,20}", lambda match: str(self.alias(int(match[0]))), value)
+        if self.pattern:
+            value = self.pattern.sub(lambda match: self.aliases.get(match[0].lower(), match[0]), value)
+        return value
+
+    def member(self, member):
+        return dict(
+            id=self.alias(member.id), name=self.alias_member(member), roles=[role.name for role in member.roles]
+        )
+
+    def command(self, ctx, content):
+        # Members designated in the command are recorded as well, so that they can be found when replaying
+        words = set(re.findall(r"\w{3,}", content.lower()))
+        members = [
+            self.member(member)
+            for member in ctx.guild.members
+            if words & set(re.findall(r"\w{3,}", f"{member.name} {member.nick or ''}".lower()))
+        ]
+        self.write(
+            "command",
+            guild=self.alias(ctx.guild.id),
+            channel=dict(id=self.alias(ctx.channel.id), name=self.alias(ctx.channel.name.lower(), "canal")),
+            author=self.member(ctx.author),
+            members=members,
+            content=self.anonymize(content),
+        )
+
+    def request(self, method, endpoint, status, duration, response):
+        self.write(
+            "request",
+            method=method,
+            endpoint=self.anonymize(endpoint),
+            status=status,
+            duration=round(duration, 3),
+            response=self.anonymize(response),
+        )
+
+    def write(self, kind, **data):
+        # Each record is a gzip member of its own, the trace stays readable when the bot is killed
+        line = json.dumps(dict(type=kind, time=round(monotonic() - self.started, 3), **data)) + "\n"
+        self.file.write(gzip.compress(line.encode("utf-8")))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Scheduler:
+
+    def __init__(self, rate=FALLOUT_BACKGROUND_RATE):
+        self.rate = rate
+        self.queue = asyncio.Queue()
+        self.jobs = {}
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = None
+
+    def begin(self):
+        self.active += 1
+        self.idle.clear()
+
+    def end(self):
+        self.active = max(self.active - 1, 0)
+        if not self.active:
+            self.idle.set()
+
+    def defer(self, key, func, *args):
+        # Pending jobs are coalesced by key, only the most recent arguments are kept
+        if key not in self.jobs:
+            self.queue.put_nowait(key)
+        self.jobs[key] = (func, args)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            key = await self.queue.get()
+            # Background jobs only run while no command is being executed
+            await self.idle.wait()
+            func, args = self.jobs.pop(key)
+            try:
+                await func(*args)
+            except Exception as error:
+                logger.error(f"Background job {key} failed: {error}")
+            await asyncio.sleep(1 / self.rate)
+
+
+class ProxyChannel:
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.outputs = []
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    async def send(self, content=None, **options):
+        self.outputs.append((content, options))
+
+
+class ProxyMessage:
+
+    def __init__(self, message, content, channel):
+        self.message = message
+        self.content = content
+        self.channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    async def delete(self, **options):
+        pass
+
+
+class ProxyContext:
+    # Runs a command on behalf of another context, collecting what is sent to its channel
+    def __init__(self, ctx, command, content, prefix=None):
+        self.ctx = ctx
+        self.command = command
+        self.invoked_with = command.name
+        self.prefix = prefix or ctx.prefix
+        self.channel = ProxyChannel(ctx.channel)
+        self.message = ProxyMessage(ctx.message, content, ctx.channel)
+
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+
+
+class Dice:
+    # Local approximation of the backend rules, only used to preview odds
+    CRITICAL_FAILURE = 96
+
+    def __init__(self, character, seed=None):
+        self.character = character
+        self.random = random.Random(seed)
+
+    def roll(self, stats, modifier=0, scale=1, trials=10000):
+        threshold = self.character.get(stats, 0) * scale + modifier
+        critical = min(self.character.get("critical_chance", self.character.get("luck", 0)), threshold)
+        failure = max(self.CRITICAL_FAILURE, threshold + 1)
+        dices = [self.random.randint(1, 100) for _ in range(trials)]
+        return dict(
+            success=sum(dice <= threshold for dice in dices) / trials,
+            critical_success=sum(dice <= critical for dice in dices) / trials,
+            critical_failure=sum(dice >= failure for dice in dices) / trials,
+        )
+
+    def damage(
+        self,
+        min_damage,
+        max_damage,
+        raw_damage=0,
+        damage_type="normal",
+        threshold_modifier=0,
+        resistance_modifier=0,
+        trials=10000,
+    ):
+        threshold = self.character.get(f"{damage_type}_threshold", 0) + threshold_modifier
+        resistance = min(max(self.character.get(f"{damage_type}_resistance", 0) + resistance_modifier, 0), 100) / 100
+        min_damage, max_damage = sorted((min_damage, max_damage))
+        return sorted(
+            max(round((self.random.randint(min_damage, max_damage) - threshold) * (1 - resistance)), 0) + raw_damage
+            for _ in range(trials)
+        )
+
+
 class Fallout(commands.Cog):
 
     INDICES = {
@@ -300,6 +1050,18 @@ class Fallout(commands.Cog):
         "knowledge": "knowledge",
     }
     STATS = {**SPECIAL, **SKILLS}
+    # Commands allowed in a batch, and whether they affect the whole campaign
+    BATCH_COMMANDS = {
+        "roll": False,
+        "damage": False,
+        "fight": False,
+        "xp": False,
+        "give": False,
+        "odds": False,
+        "copy": True,
+        "time": True,
+    }
+    SPECIAL_ORDER = ("strength", "perception", "endurance", "charisma", "intelligence", "agility", "luck")
     BODY_PARTS = {
         "t": "torso",
         "torse": "torso",
@@ -401,37 +1163,92 @@ class Fallout(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.started = monotonic()
         self.session = httpx.AsyncClient()
         self.session.headers = {
             "Content-Type": "application/json",
             "Authorization": f"TOKEN {FALLOUT_TOKEN}",
             "Accept-Language": "fr",
         }
-        self.users = {}
-        self.channels = {}
-        self.creatures = {}
+        self.users = Cache()
+        self.channels = Cache()
+        self.indices = {}
+        self.configs = {}
+        self.sheets = Cache()
+        self.listener = None
+        self.listening = False
+        self.creatures = Cache()
+        self.synchronizer = None
+        self.jobs = asyncio.Queue()
+        self.workers = []
+        self.running = set()
+        self.limiters = {}
+        self.outage = 0
+        self.outbox = None
+        self.recorder = Recorder(FALLOUT_RECORD) if FALLOUT_RECORD else None
+        self.locks = Locks()
+        self.scheduler = Scheduler()
+        self.players = {}
+        self.provisioner = None
+        self.renames = {}
+        self.channel_renames = {}
 
     @commands.Cog.listener()
     async def on_ready(self):
-        pass  # chat_exporter.init_exporter(self.bot)
+        # chat_exporter.init_exporter(self.bot)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logger.info(f"Ready in {monotonic() - self.started:.2f}s (peak RSS {rss:.1f} MiB)")
+        # Users known before they were partitioned by guild are assigned the guild of their channels
+        for _user in User.select().where(User.guild_id == 0):
+            channel = self.bot.get_channel(_user.channel_id or _user.my_channel_id or 0)
+            guild = channel.guild if channel else next((g for g in self.bot.guilds if g.get_member(_user.id)), None)
+            if guild:
+                User.update(guild_id=guild.id).where(User.guild_id == 0, User.id == _user.id).execute()
+                store.publish(User, _user.id)
+        for _user in User.select().where(User.player_id.is_null()):
+            self.provision(UserRecord.load(_user))
+        # Channels known before they were linked to their guild
+        for guild in self.bot.guilds:
+            query = Channel.select(Channel.id).where(
+                Channel.guild_id.is_null(), Channel.id.in_([channel.id for channel in guild.channels])
+            )
+            if channel_ids := [_channel.id for _channel in query]:
+                Channel.update(guild_id=guild.id).where(Channel.id.in_(channel_ids)).execute()
+                for channel_id in channel_ids:
+                    store.publish(Channel, channel_id)
+        if FALLOUT_EVENTS and not self.listener:
+            self.listener = asyncio.create_task(self.listen())
+        if store.shared and not self.synchronizer:
+            self.synchronizer = asyncio.create_task(self.synchronize())
+        if not self.workers:
+            # Interrupted jobs are resumed, unless another process may still be running them
+            running = Job.state == "running"
+            if store.shared:
+                running &= Job.updated < datetime.now() - timedelta(seconds=FALLOUT_JOB_TIMEOUT)
+            for job in Job.select(Job.id).where((Job.state == "pending") | running).order_by(Job.id):
+                self.jobs.put_nowait(job.id)
+            Job.delete().where(Job.state == "done", Job.updated < datetime.now() - timedelta(days=1)).execute()
+            self.workers = [asyncio.create_task(self.work()) for _ in range(FALLOUT_JOB_WORKERS)]
+        if not self.outbox and Outbox.select().exists():
+            self.outbox = asyncio.create_task(self.replay_outbox())
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
         if not after.bot:
-            await self.get_user(after)
+            self.scheduler.defer(("user", after.id), self.get_user, after)
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot or not message.guild:
             return
-        await self.get_user(message.author)
+        self.scheduler.defer(("user", message.author.id), self.get_user, message.author)
 
     @commands.command()
     @commands.guild_only()
     async def new(self, ctx, *args):
         """Crée un nouveau personnage avec les statistiques choisies."""
         await ctx.message.delete()
-        user = await self.get_user(ctx.author)
+        user = await self.create_player(await self.get_user(ctx.author))
         choices = tuple(range(1, 11))
         command = f"{ctx.prefix}{ctx.command.name}"
         parser = Parser(
@@ -453,44 +1270,48 @@ class Fallout(commands.Cog):
             await ctx.author.send(f"```{parser.message}```")
             return
 
-        if not args.player and user.character_id:
-            await ctx.author.send(f"⛔ Vous avez déjà créé votre personnage.")
-            return
-        data = vars(args).copy()
-        if sum(data[stats] for stats in set(self.SPECIAL.values())) != 40 and not self.has_role(ctx.author):
-            await ctx.author.send(f"⛔ La somme totale de vos statistiques doit valoir exactement **40**.")
-            return
-        data["tag_skills"] = []
-        if args.tag_skills:
-            data["tag_skills"] = [
-                self.SKILLS[t] for t in map(lambda e: e.strip().lower(), args.tag_skills) if t in self.SKILLS
-            ]
-            if len(args.tag_skills) > 3 and not self.has_role(ctx.author):
-                await ctx.author.send(f"⛔ Vous ne pouvez sélectionner que 3 spécialités au maximum.")
+        async with self.locks(("player", user.id)):
+            if not args.player and user.character_id:
+                await ctx.author.send(f"⛔ Vous avez déjà créé votre personnage.")
+                return
+            data = vars(args).copy()
+            if sum(data[stats] for stats in set(self.SPECIAL.values())) != 40 and not self.has_role(ctx.author):
+                await ctx.author.send(f"⛔ La somme totale de vos statistiques doit valoir exactement **40**.")
                 return
-        player = data.pop("player", None)
-        if self.has_role(ctx.author) and player:
-            player = await self.get_user(player)
-            if player and player.player_id:
-                data["player"] = player.player_id
-        await self.create_user(user, **data)
+            data["tag_skills"] = []
+            if args.tag_skills:
+                data["tag_skills"] = [
+                    self.SKILLS[t] for t in map(lambda e: e.strip().lower(), args.tag_skills) if t in self.SKILLS
+                ]
+                if len(args.tag_skills) > 3 and not self.has_role(ctx.author):
+                    await ctx.author.send(f"⛔ Vous ne pouvez sélectionner que 3 spécialités au maximum.")
+                    return
+            player = data.pop("player", None)
+            if self.has_role(ctx.author) and player:
+                player = await self.get_user(player, ctx.guild)
+                if player and not isinstance(player, CreatureRecord):
+                    player = await self.create_player(player)
+                if player and player.player_id:
+                    data["player"] = player.player_id
+            await self.create_user(user, campaign=self.get_config(ctx.guild).campaign_id, **data)
         url = await self.get_character_url(user)
         await ctx.author.send(f"✅ Votre personnage a été créé avec succès ! Fiche de personnage : {url}")
-        player_role = utils.get(ctx.channel.guild.roles, name=DISCORD_PLAYER_ROLE)
-        await user.user.add_roles(player_role, reason="Nouveau joueur")
+        index, config = self.get_index(ctx.guild), self.get_config(ctx.guild)
+        player_role = index.roles.get(config.player_role)
+        await ctx.author.add_roles(player_role, reason="Nouveau joueur")
         # Create private channel
-        channel_name = user.name.lower().replace("#", "").replace(" ", "-").replace("_", "-")
-        category = utils.get(ctx.channel.guild.categories, name=DISCORD_CATEGORY)
-        new_channel = utils.get(ctx.channel.guild.text_channels, name=channel_name, category=category)
+        channel_name = normalize(user.name)
+        category = index.categories.get(config.category)
+        new_channel = index.get_channel(channel_name, category=category)
         if not new_channel:
             new_channel = await ctx.channel.guild.create_text_channel(channel_name, category=category, topic=user.name)
-            everyone = utils.get(ctx.channel.guild.roles, name="@everyone")
-            gm_role = utils.get(ctx.channel.guild.roles, name=DISCORD_ADMIN_ROLE)
-            await new_channel.set_permissions(everyone, read_messages=False)
+            index.add_channel(new_channel)
+            gm_role = index.roles.get(config.admin_role)
+            await new_channel.set_permissions(ctx.guild.default_role, read_messages=False)
             await new_channel.set_permissions(gm_role, read_messages=True)
-            await new_channel.set_permissions(user.user, read_messages=True)
+            await new_channel.set_permissions(ctx.author, read_messages=True)
             user.my_channel_id = new_channel.id
-            user.save(only=("my_channel_id",))
+            user.save("my_channel_id")
 
     @commands.command()
     @commands.guild_only()
@@ -498,8 +1319,9 @@ class Fallout(commands.Cog):
         """Retourne un lien vers votre fiche de personnage."""
         await ctx.message.delete()
         user = await self.get_user(ctx.author)
-        if not user or not user.player_id:
+        if not user:
             return
+        await self.create_player(user)
         url = await self.get_character_url(user)
         if not user.character_id:
             await ctx.author.send(
@@ -509,7 +1331,56 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    async def sheet(self, ctx, *args):
+        """Affiche l'état d'un personnage."""
+        await ctx.message.delete()
+        user = await self.get_user(ctx.author)
+        command = f"{ctx.prefix}{ctx.command.name}"
+        parser = Parser(prog=command, description="Affiche l'état d'un personnage.")
+        parser.add_argument("player", type=str, nargs="?", help="Nom du joueur (MJ uniquement)")
+        parser.add_argument("--show", "-s", action="store_true", default=False, help="Afficher dans le canal ?")
+        args = parser.parse_args(args)
+        if parser.message:
+            await ctx.author.send(f"```{parser.message}```")
+            return
+
+        is_admin = self.has_role(ctx.author)
+        player = await self.get_user(args.player, ctx.guild) if args.player and is_admin else user
+        if not player or not player.character_id:
+            await ctx.author.send(f"⚠️ Aucun personnage actif n'a été trouvé.")
+            return
+        character = await self.get_sheet(player.character_id)
+        if not character:
+            await ctx.author.send(f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{command}`.")
+            return
+        lines = []
+        if "level" in character:
+            lines.append(f"🆙 Niveau **{character['level']}** ({character.get('experience', 0)} XP)")
+        for icon, label, key in (("❤️", "Santé", "health"), ("⚡", "Points d'action", "action_points")):
+            if key in character:
+                maximum = character.get(f"max_{key}")
+                value = f"{character[key]}/{maximum}" if maximum is not None else character[key]
+                lines.append(f"{icon} {label} : **{value}**")
+        for icon, label, key in (("☢️", "Radiations", "radiation"), ("💰", "Argent", "money")):
+            if character.get(key):
+                lines.append(f"{icon} {label} : **{character[key]}**")
+        special = [f"{stats[0].upper()} **{character[stats]}**" for stats in self.SPECIAL_ORDER if stats in character]
+        if special:
+            lines.append(" · ".join(special))
+        dead = character.get("health", 1) <= 0
+        embed = Embed(
+            title=f"📋 {character.get('name', player.name)}",
+            description="\n".join(lines),
+            color=self.get_color("red") if dead else self.get_color("blue"),
+        )
+        if args.show and is_admin:
+            await ctx.channel.send(embed=embed)
+        else:
+            await ctx.author.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @is_game_master()
     async def move(self, ctx, *args):
         """Déplace un ou plusieurs joueurs dans un autre canal."""
         await ctx.message.delete()
@@ -526,101 +1397,60 @@ class Fallout(commands.Cog):
             return
 
         channel_id = self.extract_id(args.channel)
-        category = utils.get(ctx.channel.guild.categories, name=DISCORD_WORLD)
+        index, config = self.get_index(ctx.guild), self.get_config(ctx.guild)
+        category = index.categories.get(config.world)
         if not channel_id:
-            channel_name = args.channel.lower().replace("#", "").replace(" ", "-").replace("_", "-")
-            new_channel = utils.get(ctx.channel.guild.text_channels, name=channel_name, category=category)
+            channel_name = normalize(args.channel)
+            new_channel = index.get_channel(channel_name, category=category)
             if not new_channel:
                 new_channel = await ctx.channel.guild.create_text_channel(
-                    channel_name, category=category, topic=args.topic
+                    channel_name,
+                    category=category,
+                    topic=args.topic,
+                    overwrites={ctx.guild.default_role: PermissionOverwrite(read_messages=False)},
                 )
-                everyone = utils.get(ctx.channel.guild.roles, name="@everyone")
-                await new_channel.set_permissions(everyone, read_messages=False)
+                index.add_channel(new_channel)
         else:
             new_channel = self.bot.get_channel(channel_id)
+        if not new_channel:
+            await ctx.author.send(f"⚠️ Le canal `{args.channel}` n'existe pas.")
+            return
         _old_channel = await self.get_channel(ctx.channel, user) if ctx.channel.category == category else None
         _new_channel = await self.get_channel(
             new_channel, user, date=parse_date(args.date, dayfirst=True) if args.date else None
         )
-        players_in_channel = User.select().where(User.channel == _new_channel)
-        if _old_channel and _new_channel and players_in_channel.count() == 0 and _new_channel.date != _old_channel.date:
-            _new_channel.date = _old_channel.date
-            _new_channel.save(only=("date",))
-            await self.request(
-                f"campaign/{_new_channel.campaign_id}/",
-                method="patch",
-                data=dict(
-                    start_game_date=_new_channel.date.isoformat(), current_game_date=_new_channel.date.isoformat()
-                ),
-            )
-        if new_channel.members:
-            deleted_messages = await new_channel.purge()
-            if deleted_messages:
-                transcript = await chat_exporter.raw_export(new_channel, deleted_messages, set_timezone="Europe/Paris")
-                if transcript:
-                    for player in players_in_channel:
-                        if not player.my_channel_id:
-                            continue
-                        channel = self.bot.get_channel(player.my_channel_id)
-                        if channel:
-                            file = File(io.BytesIO(transcript.encode()), filename=f"{new_channel.name}.html")
-                            await channel.send(
-                                f"🚪 Un ou plusieurs joueurs sont entrés dans **#{new_channel.name}**, "
-                                f"les messages du canal ont été purgés par soucis de discrétion.\n"
-                                f"⌚ Vous pouvez retrouver l'historique des messages ci-dessous :",
-                                file=file,
-                            )
-        arriving_users, leaving_users = [], {}
+        players = []
         for player_name in args.players:
-            player = await self.get_user(player_name)
-            if not player:
+            player = await self.get_user(player_name, ctx.guild)
+            if not player or isinstance(player, CreatureRecord):
                 logger.warning(f"Player '{player_name}' not found!")
                 continue
-            if player and player.channel_id:
-                old_channel = self.bot.get_channel(player.channel_id)
-                if old_channel:
-                    if player.my_channel_id:
-                        channel = self.bot.get_channel(player.my_channel_id)
-                        transcript = await chat_exporter.export(old_channel, set_timezone="Europe/Paris")
-                        if channel and transcript:
-                            file = File(io.BytesIO(transcript.encode()), filename=f"{old_channel.name}.html")
-                            await channel.send(
-                                f"🚪 Vous avez été déplacé de **#{old_channel.name}** "
-                                f"vers **#{new_channel.name}**.\n"
-                                f"⌚ Vous pouvez retrouver l'historique des messages ci-dessous :",
-                                file=file,
-                            )
-                    await old_channel.set_permissions(player.user, overwrite=None)
-                    leaving_users.setdefault(old_channel.id, []).append(player)
-            player.channel_id = new_channel.id
-            player.save(only=("channel_id",))
-            arriving_users.append(player)
-            await new_channel.set_permissions(player.user, read_messages=True)
-            await self.request(
-                f"character/{player.character_id}/",
-                method="patch",
-                data=dict(campaign=_new_channel.campaign_id),
+            players.append(player)
+        keys = [("campaign", _channel.campaign_id) for _channel in (_old_channel, _new_channel) if _channel]
+        keys += [("channel", channel_id) for channel_id in {new_channel.id, *(p.channel_id for p in players)}]
+        keys += [("character", player.character_id) for player in players]
+        # Each step can be run again safely if the job is interrupted
+        moves = [(player.id, player.channel_id) for player in players]
+        steps = []
+        if _old_channel:
+            steps.append(("sync_date", dict(channel_id=new_channel.id, date_channel_id=_old_channel.id)))
+        if new_channel.members:
+            steps.append(("purge_channel", dict(channel_id=new_channel.id)))
+        for player in players:
+            params = dict(
+                user_id=player.id,
+                guild_id=player.guild_id,
+                old_channel_id=player.channel_id,
+                campaign_id=_new_channel.campaign_id,
             )
-        gm_role = utils.get(ctx.channel.guild.roles, name=DISCORD_ADMIN_ROLE)
-        await new_channel.set_permissions(gm_role, read_messages=True)
-        for channel_id, users in leaving_users.items():
-            old_channel = self.bot.get_channel(channel_id)
-            if not old_channel:
-                continue
-            user_names = ", ".join([f"<@{user.id}>" for user in users])
-            if len(users) > 1:
-                await old_channel.send(f"📤 {user_names} partent de <#{old_channel.id}>.")
-                continue
-            await old_channel.send(f"📤 {user_names} part de <#{old_channel.id}>.")
-        user_names = ", ".join([f"<@{user.id}>" for user in arriving_users])
-        if len(arriving_users) > 1:
-            await new_channel.send(f"📥 {user_names} arrivent dans <#{new_channel.id}>.")
-            return
-        await new_channel.send(f"📥 {user_names} arrive dans <#{new_channel.id}>.")
+            steps.append(("move_player", dict(params, channel_id=new_channel.id)))
+        steps.append(("update_permissions", dict(channel_id=new_channel.id, moves=moves)))
+        steps.append(("announce_move", dict(channel_id=new_channel.id, moves=moves)))
+        self.enqueue("move", f"Déplacement vers #{new_channel.name}", ctx.author, keys, steps)
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def roll(self, ctx, *args):
         """Réalise un jet de compétence ou de S.P.E.C.I.A.L. pour un ou plusieurs joueurs."""
         await ctx.message.delete()
@@ -630,7 +1460,7 @@ class Fallout(commands.Cog):
             prog=command, description="Réalise un jet de compétence ou de S.P.E.C.I.A.L. pour un ou plusieurs joueurs."
         )
         parser.add_argument("stats", type=str, help="Nom ou code de la statistique")
-        parser.add_argument("players", metavar="player", type=str, nargs="+", help="Nom du joueur")
+        parser.add_argument("players", metavar="player", type=str, nargs="+", help=TARGETS_HELP)
         parser.add_argument("--modifier", "-m", metavar="MOD", default=0, type=int, help="Modificateur")
         parser.add_argument("--xp", "-x", action="store_false", default=True, help="Pas d'expérience ?")
         parser.add_argument("--reason", "-R", type=str, default="", help="Explication")
@@ -643,14 +1473,13 @@ class Fallout(commands.Cog):
         args.stats = self.try_get(args.stats, self.STATS)
         data = vars(args).copy()
         data.pop("players")
-        for player_name in args.players:
-            player = await self.get_user(player_name)
-            if not player or not player.character_id:
+        players = await self.get_targets(args.players, ctx.guild)
+        results = await self.dispatch(players, "roll", data)
+        for player, ret in zip(players, results):
+            if not isinstance(ret, dict):
+                await ctx.author.send(f"⚠️ La commande `{command}` a échoué pour **{player.name}**.")
                 continue
-            ret = await self.request(f"character/{player.character_id}/roll/", method="post", data=data)
-            if ret is None:
-                await ctx.author.send(f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{command}`.")
-                return
+            self.update_sheet(ret["character"])
             success, critical, stats, label = ret["success"], ret["critical"], ret["stats_display"], ret["long_label"]
             experience, level_up, level = ret["experience"], ret["level_up"], ret["character"]["level"]
             who = f"<@{player.id}>" if args.tag else f"**{ret["character"]["name"]}**"
@@ -672,7 +1501,7 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def damage(self, ctx, *args):
         """Inflige des dégâts à un ou plusieurs joueurs."""
         await ctx.message.delete()
@@ -721,7 +1550,7 @@ class Fallout(commands.Cog):
         parser.add_argument("--simulation", "-s", action="store_true", default=False, help="Simulation ?")
         parser.add_argument("--reason", "-R", type=str, default="", help="Explication")
         parser.add_argument("--tag", "-T", action="store_true", default=False, help="Mentionner ?")
-        parser.add_argument("players", metavar="player", type=str, nargs="+", help="Nom du joueur")
+        parser.add_argument("players", metavar="player", type=str, nargs="+", help=TARGETS_HELP)
         args = parser.parse_args(args)
         if parser.message:
             await ctx.author.send(f"```{parser.message}```")
@@ -731,14 +1560,14 @@ class Fallout(commands.Cog):
         args.body_part = self.try_get(args.body_part, self.BODY_PARTS) if args.body_part else None
         data = vars(args).copy()
         data.pop("players")
-        for player_name in args.players:
-            player = await self.get_user(player_name)
-            if not player or not player.character_id:
+        players = await self.get_targets(args.players, ctx.guild)
+        results = await self.dispatch(players, "damage", data)
+        for player, ret in zip(players, results):
+            if not isinstance(ret, dict):
+                await ctx.author.send(f"⚠️ La commande `{command}` a échoué pour **{player.name}**.")
                 continue
-            ret = await self.request(f"character/{player.character_id}/damage/", method="post", data=data)
-            if ret is None:
-                await ctx.author.send(f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{command}`.")
-                return
+            if not args.simulation:
+                self.update_sheet(ret["character"])
             who = f"<@{player.id}>" if args.tag else f"**{ret["character"]["name"]}**"
             if args.reason:
                 message = f"> {args.reason}\n\n{who} a reçu **{ret['long_label']}**"
@@ -755,7 +1584,7 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def fight(self, ctx, *args):
         """Fait s'affronter deux joueurs entre eux."""
         await ctx.message.delete()
@@ -840,17 +1669,23 @@ class Fallout(commands.Cog):
             return
 
         args.body_part = self.try_get(args.target_body_part, self.BODY_PARTS)
-        attacker, defender = await self.get_user(args.attacker), await self.get_user(args.defender)
+        attacker, defender = await self.get_user(args.attacker, ctx.guild), await self.get_user(
+            args.defender, ctx.guild
+        )
         if not attacker or not defender or not attacker.character_id or not defender.character_id:
             await ctx.author.send(f"⚠️ Les joueurs sélectionnés ne peuvent combattre car ils n'ont pas de personnage.")
             return
         data = vars(args).copy()
         data.pop("attacker")
         data["target"] = defender.character_id
-        ret = await self.request(f"character/{attacker.character_id}/fight/", method="post", data=data)
+        async with self.locks(("character", attacker.character_id), ("character", defender.character_id)):
+            ret = await self.request(f"character/{attacker.character_id}/fight/", method="post", data=data)
         if ret is None:
             await ctx.author.send(f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{command}`.")
             return
+        if not args.simulation:
+            self.sheets.pop(defender.character_id, None)
+            self.update_sheet(ret["character"])
         if args.tag:
             attacker = f"**<@{attacker.id}>**" if attacker.id else f"**{attacker.name}** (*{attacker.character_id}*)"
             defender = f"**<@{defender.id}>**" if defender.id else f"**{defender.name}** (*{defender.character_id}*)"
@@ -876,7 +1711,85 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
+    async def odds(self, ctx, *args):
+        """Estime localement les chances de réussite ou les dégâts subis par un ou plusieurs joueurs."""
+        await ctx.message.delete()
+        user = await self.get_user(ctx.author)
+        command = f"{ctx.prefix}{ctx.command.name}"
+        parser = Parser(
+            prog=command,
+            description="Estime localement les chances de réussite ou les dégâts subis par un ou plusieurs joueurs.",
+            epilog="Les probabilités sont simulées sans appeler le serveur et peuvent différer légèrement des règles.",
+        )
+        parser.add_argument("players", metavar="player", type=str, nargs="+", help=TARGETS_HELP)
+        parser.add_argument("--stats", "-S", type=str, help="Nom ou code de la statistique")
+        parser.add_argument("--modifier", "-m", metavar="MOD", default=0, type=int, help="Modificateur")
+        parser.add_argument(
+            "--damage",
+            "-d",
+            metavar=("MIN", "MAX", "RAW"),
+            type=int,
+            nargs=3,
+            help="Dégâts minimals, maximals et bruts",
+        )
+        parser.add_argument("--type", "-t", metavar="TYPE", dest="damage_type", type=str, default="normal", help="Type")
+        parser.add_argument("--threshold", "-a", metavar="MOD", type=int, default=0, help="Modificateur d'absorption")
+        parser.add_argument("--resistance", "-r", metavar="MOD", type=int, default=0, help="Modificateur de résistance")
+        parser.add_argument("--trials", "-n", type=int, default=10000, help="Nombre de simulations")
+        args = parser.parse_args(args)
+        if parser.message:
+            await ctx.author.send(f"```{parser.message}```")
+            return
+        if not args.stats and not args.damage:
+            await ctx.author.send(f"⚠️ Précisez une statistique (`--stats`) ou des dégâts (`--damage`).")
+            return
+
+        trials = min(max(args.trials, 1), FALLOUT_MAX_TRIALS)
+        stats = self.try_get(args.stats, self.STATS) if args.stats else None
+        damage_type = self.try_get(args.damage_type, self.DAMAGES)
+        for player in await self.get_targets(args.players, ctx.guild):
+            character = await self.get_sheet(player.character_id)
+            if not character:
+                continue
+            dice, lines = Dice(character), []
+            if stats:
+                scale = 10 if stats in self.SPECIAL_ORDER else 1
+                # Simulations are run in a thread so that they do not block the event loop
+                ret = await asyncio.to_thread(dice.roll, stats, modifier=args.modifier, scale=scale, trials=trials)
+                lines.append(
+                    f"🎲 **{stats}** : {self.STATUS[1, 0]} **{ret['success']:.1%}** "
+                    f"(dont {self.STATUS[1, 1]} {ret['critical_success']:.1%}) · "
+                    f"{self.STATUS[0, 0]} **{1 - ret['success']:.1%}** "
+                    f"(dont {self.STATUS[0, 1]} {ret['critical_failure']:.1%})"
+                )
+            if args.damage:
+                results = await asyncio.to_thread(
+                    dice.damage,
+                    *args.damage,
+                    damage_type=damage_type,
+                    threshold_modifier=args.threshold,
+                    resistance_modifier=args.resistance,
+                    trials=trials,
+                )
+                quartiles = " / ".join(str(results[len(results) * q // 4]) for q in (1, 2, 3))
+                lines.append(
+                    f"💥 **{damage_type}** : moyenne **{sum(results) / len(results):.1f}** "
+                    f"(min {results[0]}, quartiles {quartiles}, max {results[-1]})"
+                )
+                if (health := character.get("health")) is not None:
+                    lethal = sum(result >= health for result in results) / len(results)
+                    lines.append(f"💀 Probabilité de mort : **{lethal:.1%}**")
+            embed = Embed(
+                title=f"🔮 Estimation pour {character.get('name', player.name)}",
+                description="\n".join(lines),
+            )
+            embed.set_footer(text=f"{trials} simulations locales")
+            await ctx.author.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @is_game_master()
     async def copy(self, ctx, *args):
         """Copie un ou plusieurs personnages dans la campagne courante."""
         await ctx.message.delete()
@@ -886,6 +1799,7 @@ class Fallout(commands.Cog):
         parser.add_argument("character", type=int, help="Identifiant du personnage")
         parser.add_argument("--name", "-n", type=str, default="", help="Nouveau nom du personnage")
         parser.add_argument("--count", "-c", type=int, default=1, help="Nombre de personnages")
+        parser.add_argument("--squad", "-q", type=str, default="", help="Nom de l'escouade (par défaut : le nom)")
         args = parser.parse_args(args)
         if parser.message:
             await ctx.author.send(f"```{parser.message}```")
@@ -896,25 +1810,34 @@ class Fallout(commands.Cog):
             return
         data = vars(args).copy()
         data.pop("character")
+        data.pop("squad")
         data.update(campaign=_channel.campaign_id)
-        ret = await self.request(f"character/{args.character}/copy/", method="post", data=data)
+        async with self.locks(("campaign", _channel.campaign_id)):
+            ret = await self.request(f"character/{args.character}/copy/", method="post", data=data)
         if ret is None:
             return
+        if not ret:
+            return
+        squad = normalize(args.squad or args.name or ret[0]["name"])
+        rows = [
+            dict(character_id=c["id"], name=c["name"], campaign_id=c["campaign"], guild_id=ctx.guild.id, squad=squad)
+            for c in ret
+        ]
+        Creature.insert_many(rows).on_conflict_replace().execute()
         creatures = []
-        for creature in ret:
-            self.creatures[args.character] = creature = Creature(
-                id=0, name=creature["name"], character_id=creature["id"], campaign_id=creature["campaign"]
-            )
+        for row in rows:
+            self.creatures[row["character_id"]] = creature = CreatureRecord(id=0, **row)
             creatures.append(creature)
+            store.publish(Creature, creature.character_id)
         creature_names = ", ".join([f"**{c.name}** (*{c.character_id}*)" for c in creatures])
         if len(creatures) > 1:
-            await ctx.channel.send(f"🚪 {creature_names} apparaissent dans <#{ctx.channel.id}>.")
+            await ctx.channel.send(f"🚪 {creature_names} apparaissent dans <#{ctx.channel.id}> (escouade `@{squad}`).")
             return
-        await ctx.channel.send(f"🚪 {creature_names} apparaît dans <#{ctx.channel.id}>.")
+        await ctx.channel.send(f"🚪 {creature_names} apparaît dans <#{ctx.channel.id}> (escouade `@{squad}`).")
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def time(self, ctx, *args):
         """Avance dans le temps et passe éventuellement au tour du personnage suivant."""
         await ctx.message.delete()
@@ -936,46 +1859,23 @@ class Fallout(commands.Cog):
             await ctx.author.send(f"```{parser.message}```")
             return
 
-        async def proceed(_channel):
-            channel = _channel.channel
-            seconds = int(timedelta(seconds=args.seconds, minutes=args.minutes, hours=args.hours).total_seconds())
-            data = dict(resting=args.resting, reset=not args.turn, seconds=seconds)
-            ret = await self.request(f"campaign/{_channel.campaign_id}/next/", method="post", data=data)
-            if ret is None:
-                return
-            date = parse_date(ret["campaign"]["current_game_date"])
-            messages = []
-            if args.reason:
-                messages.append(f"> {args.reason}\n")
-            if seconds:
-                messages.append(f"⌛ **{args.hours:02}:{args.minutes:02}:{args.seconds:02}** se sont écoulées !")
-            messages.append(f"📅 Nous sommes désormais le **{date:%A %d %B %Y}** et il est **{date:%H:%M:%S}**.")
-            if ret.get("character"):
-                try:
-                    _user = User.get(User.character_id == ret["character"]["id"])
-                    who = f"<@{_user.id}>" if args.tag else f"**{ret["character"]["name"]}**"
-                    messages.append(f"🔁 C'est désormais au tour de {who}.")
-                except:
-                    character = ret["character"]
-                    messages.append(f"🔁 C'est désormais au tour de **{character['name']}** ({character['id']}).")
-            for damage in ret.get("damages", []):
-                messages.append(f"> {ret['icon']}  **{damage['character']['name']}** a reçu **{ret['long_label']}**")
-            embed = Embed(title=f"⏰ Le temps passe...", description="\n".join(messages))
-            await channel.send(embed=embed)
-
         if args.all:
-            for _channel in Channel.select().where(Channel.campaign_id.is_null(False)):
-                _channel.channel = self.bot.get_channel(_channel.id)
-                await proceed(_channel)
+            # Campaigns are advanced one by one in the background, each step locks its own campaign
+            _channels = Channel.select().where(Channel.guild_id == ctx.guild.id, Channel.campaign_id.is_null(False))
+            steps = [
+                ("advance_time", dict(channel_id=c.id, campaign_id=c.campaign_id, options=vars(args)))
+                for c in _channels
+            ]
+            self.enqueue("time", "Passage du temps dans toutes les campagnes", ctx.author, [], steps)
         else:
             _channel = await self.get_channel(ctx.channel, user)
             if not _channel or not _channel.campaign_id:
                 return
-            await proceed(_channel)
+            await self.advance_time(ctx.channel, _channel.campaign_id, vars(args))
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def give(self, ctx, *args):
         """Donne un ou plusieurs objets à un personnage donné."""
         await ctx.message.delete()
@@ -994,28 +1894,31 @@ class Fallout(commands.Cog):
             await ctx.author.send(f"```{parser.message}```")
             return
 
-        _user = await self.get_user(args.player)
+        _user = await self.get_user(args.player, ctx.guild)
         if not _user:
             return
         if args.item.isdigit():
-            ret = await self.request(f"item/?id={args.item}&fields=id,name&all=1")
+            ret = await self.fetch(f"item/?id={args.item}", limit=2, fields=("id", "name"))
         else:
-            ret = await self.request(
-                f'item/?filters=or(name_fr.icontains:"{args.item}",'
-                f'name_en.icontains:"{args.item}")&fields=id,name&all=1'
+            ret = await self.fetch(
+                f'item/?filters=or(name_fr.icontains:"{args.item}",name_en.icontains:"{args.item}")',
+                limit=2,
+                fields=("id", "name"),
             )
-        if not ret or len(ret) > 1:
-            await ctx.author.send(f"⚠️ Aucun ou trop (**{len(ret)}**) d'objets correspondent à la recherche.")
+        if len(ret) != 1:
+            await ctx.author.send(f"⚠️ Aucun ou trop d'objets correspondent à la recherche.")
             return
         data = vars(args).copy()
         data.pop("player")
         data.pop("image")
         silent = data.pop("silent")
         data["item"], item_name = ret[0]["id"], ret[0]["name"]
-        ret = await self.request(f"character/{_user.character_id}/item/", method="post", data=data)
+        async with self.locks(("character", _user.character_id)):
+            ret = await self.request(f"character/{_user.character_id}/item/", method="post", data=data)
         if not ret:
             await ctx.author.send(f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{OP}give`.")
             return
+        self.update_sheet(ret["character"])
         if not silent:
             who = f"<@{_user.id}>" if args.tag else f"**{ret["character"]["name"]}**"
             embed = Embed(
@@ -1032,7 +1935,7 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def open(self, ctx, *args):
         """Ouvre un butin avec éventuellement un personnage donné."""
         await ctx.message.delete()
@@ -1052,21 +1955,24 @@ class Fallout(commands.Cog):
         if not _channel or not _channel.campaign_id:
             return
         data = {"campaign": _channel.campaign_id}
-        _user = await self.get_user(args.player)
+        _user = await self.get_user(args.player, ctx.guild)
         if _user:
             data["character"] = _user.character_id
         if args.loot.isdigit():
-            ret = await self.request(f"loottemplate/?id={args.loot}&fields=id,name&all=1")
+            ret = await self.fetch(f"loottemplate/?id={args.loot}", limit=2, fields=("id", "name"))
         else:
-            ret = await self.request(
-                f'loottemplate/?filters=or(name_fr.icontains:"{args.loot}",'
-                f'name_en.icontains:"{args.loot}")&fields=id,name&all=1'
+            ret = await self.fetch(
+                f'loottemplate/?filters=or(name_fr.icontains:"{args.loot}",name_en.icontains:"{args.loot}")',
+                limit=2,
+                fields=("id", "name"),
             )
-        if not ret or len(ret) > 1:
-            await ctx.author.send(f"⚠️ Aucun ou trop (**{len(ret)}**) de butins correspondent à la recherche.")
+        if len(ret) != 1:
+            await ctx.author.send(f"⚠️ Aucun ou trop de butins correspondent à la recherche.")
             return
         loot_id, loot_name = ret[0]["id"], ret[0]["name"]
-        ret = await self.request(f"loottemplate/{loot_id}/open/", method="post", data=data)
+        async with self.locks(("campaign", _channel.campaign_id), ("character", data.get("character"))):
+            ret = await self.request(f"loottemplate/{loot_id}/open/", method="post", data=data)
+        self.sheets.pop(data.get("character"), None)
         if not args.silent:
             if _user and args.tag:
                 description = f"**{loot_name}** a été ouvert par <@{_user.id}> !"
@@ -1095,7 +2001,7 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def say(self, ctx, *args):
         """Ouvre une fenêtre de dialogue riche."""
         await ctx.message.delete()
@@ -1121,7 +2027,7 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def xp(self, ctx, *args):
         """Ajoute de l'expérience à un ou plusieurs personnages."""
         await ctx.message.delete()
@@ -1129,7 +2035,7 @@ class Fallout(commands.Cog):
         command = f"{ctx.prefix}{ctx.command.name}"
         parser = Parser(prog=command, description="Ajoute de l'expérience à un ou plusieurs personnages.")
         parser.add_argument("amount", type=int, help="Quantité d'expérience")
-        parser.add_argument("players", metavar="player", type=str, nargs="+", help="Nom du joueur")
+        parser.add_argument("players", metavar="player", type=str, nargs="+", help=TARGETS_HELP)
         parser.add_argument("--reason", "-R", type=str, default="", help="Raison")
         parser.add_argument("--tag", "-T", action="store_true", default=False, help="Mentionner ?")
         args = parser.parse_args(args)
@@ -1140,16 +2046,13 @@ class Fallout(commands.Cog):
         xp = args.amount
         data = vars(args).copy()
         data.pop("players")
-        for player_name in args.players:
-            player = await self.get_user(player_name)
-            if not player or not player.character_id:
+        players = await self.get_targets(args.players, ctx.guild)
+        results = await self.dispatch(players, "xp", data)
+        for player, ret in zip(players, results):
+            if not isinstance(ret, dict):
+                await ctx.author.send(f"⚠️ La commande `{OP}{command}` a échoué pour **{player.name}**.")
                 continue
-            ret = await self.request(f"character/{player.character_id}/xp/", method="post", data=data)
-            if ret is None:
-                await ctx.author.send(
-                    f"⚠️ Une erreur s'est produite pendant l'exécution de la commande `{OP}{command}`."
-                )
-                return
+            self.update_sheet(ret)
             req_xp, level, level_up = ret["required_experience"], ret["level"], ret["level_up"]
             who = f"<@{player.id}>" if args.tag else f"**{ret["name"]}**"
             reason = f"> {args.reason}\n\n" if args.reason else ""
@@ -1173,11 +2076,11 @@ class Fallout(commands.Cog):
 
     @commands.command()
     @commands.guild_only()
-    @commands.has_role(DISCORD_ADMIN_ROLE)
+    @is_game_master()
     async def purge(self, ctx):
         await ctx.message.delete()
         players_in_channel = User.select().where(User.channel == ctx.channel.id)
-        deleted_messages = await ctx.channel.purge()
+        deleted_messages = await self.purge_messages(ctx.channel)
         if deleted_messages:
             transcript = await chat_exporter.raw_export(ctx.channel, deleted_messages, tz_info="Europe/Paris")
             if transcript:
@@ -1193,31 +2096,567 @@ class Fallout(commands.Cog):
                             file=file,
                         )
 
+    @commands.command()
+    @commands.guild_only()
+    @is_game_master()
+    async def jobs(self, ctx, *args):
+        """Affiche, reprend ou annule les opérations en cours d'exécution."""
+        await ctx.message.delete()
+        command = f"{ctx.prefix}{ctx.command.name}"
+        parser = Parser(prog=command, description="Affiche, reprend ou annule les opérations en cours d'exécution.")
+        parser.add_argument("--retry", "-r", metavar="ID", type=int, help="Reprendre une opération échouée")
+        parser.add_argument("--cancel", "-c", metavar="ID", type=int, help="Annuler une opération")
+        args = parser.parse_args(args)
+        if parser.message:
+            await ctx.author.send(f"```{parser.message}```")
+            return
+
+        if args.retry:
+            if Job.update(state="pending").where(Job.id == args.retry, Job.state == "failed").execute():
+                self.jobs.put_nowait(args.retry)
+        if args.cancel:
+            Job.delete().where(Job.id == args.cancel, Job.state != "running").execute()
+        jobs = Job.select().where(Job.author_id == ctx.author.id, Job.state != "done").order_by(Job.id)
+        lines = []
+        for job in jobs:
+            status = {"pending": "🕒", "running": "⏳", "failed": "⚠️"}.get(job.state, "")
+            total = len(json.loads(job.data)["steps"])
+            lines.append(f"{status} **#{job.id}** {job.label} : {job.position}/{total} étapes")
+            if job.error:
+                lines.append(f"> {job.error}")
+        embed = Embed(title=f"🛠️ Opérations en cours", description="\n".join(lines) or "Aucune opération en cours.")
+        await ctx.author.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def config(self, ctx, *args):
+        """Affiche ou modifie la configuration du bot pour ce serveur."""
+        await ctx.message.delete()
+        command = f"{ctx.prefix}{ctx.command.name}"
+        parser = Parser(prog=command, description="Affiche ou modifie la configuration du bot pour ce serveur.")
+        parser.add_argument("--admin", "-a", dest="admin_role", type=str, help="Rôle des maîtres du jeu")
+        parser.add_argument("--player", "-p", dest="player_role", type=str, help="Rôle des joueurs")
+        parser.add_argument("--category", "-c", type=str, help="Catégorie des canaux privés des joueurs")
+        parser.add_argument("--world", "-w", type=str, help="Catégorie des canaux du monde")
+        parser.add_argument("--campaign", "-C", dest="campaign_id", type=int, help="Campagne des nouveaux personnages")
+        args = parser.parse_args(args)
+        if parser.message:
+            await ctx.author.send(f"```{parser.message}```")
+            return
+
+        config = self.get_config(ctx.guild)
+        fields = [name for name, value in vars(args).items() if value is not None]
+        for name in fields:
+            setattr(config, name, vars(args)[name])
+        if fields:
+            config.save(*fields)
+        embed = Embed(title=f"⚙️ Configuration de {ctx.guild.name}")
+        embed.add_field(name="Maîtres du jeu", value=config.admin_role)
+        embed.add_field(name="Joueurs", value=config.player_role)
+        embed.add_field(name="Canaux privés", value=config.category)
+        embed.add_field(name="Monde", value=config.world)
+        embed.add_field(name="Campagne", value=config.campaign_id or "-")
+        await ctx.author.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @is_game_master()
+    async def batch(self, ctx, *, script: str = ""):
+        """Exécute plusieurs commandes, une par ligne, et publie leurs résultats ensemble."""
+        await ctx.message.delete()
+        user = await self.get_user(ctx.author)
+        lines = []
+        for line in filter(None, map(str.strip, script.splitlines())):
+            args = split_arguments(line.removeprefix(ctx.prefix))
+            command = self.bot.get_command(args[0])
+            if not command or command.cog is not self or command.name not in self.BATCH_COMMANDS:
+                await ctx.author.send(f"⚠️ La commande `{line}` ne peut pas être exécutée dans un lot.")
+                return
+            lines.append((ProxyContext(ctx, command, line), args[1:]))
+        if not lines:
+            await ctx.author.send(f"⚠️ Précisez une commande par ligne après `{ctx.prefix}{ctx.command.name}`.")
+            return
+
+        # Lines run concurrently in waves, a new wave starts when a line shares a character with the current one
+        waves, targets, exclusive = [], set(), True
+        for proxy, args in lines:
+            group = self.BATCH_COMMANDS[proxy.command.name]
+            characters = set() if group else await self.get_batch_targets(proxy, args)
+            if exclusive or group or characters & targets:
+                waves.append([])
+                targets = set()
+            waves[-1].append((proxy, args))
+            targets, exclusive = targets | characters, group
+        for wave in waves:
+            await asyncio.gather(*(self.run_proxy(proxy, args) for proxy, args in wave))
+        await self.send_outputs(ctx.channel.send, [output for proxy, args in lines for output in proxy.channel.outputs])
+
+    async def get_batch_targets(self, proxy, args):
+        # The line is parsed by its own command, then its targets are resolved to characters
+        token = dry_run.set(True)
+        try:
+            await proxy.command.callback(self, proxy, *args)
+            namespace = None
+        except Parsed as parsed:
+            namespace = parsed.args[0]
+        finally:
+            dry_run.reset(token)
+        names = []
+        for name in ("players", "player", "attacker", "defender"):
+            value = getattr(namespace, name, None)
+            names.extend(value if isinstance(value, list) else [value] if value else [])
+        return {player.character_id for player in await self.get_targets(names, proxy.guild)}
+
+    async def run_proxy(self, proxy, args):
+        try:
+            await proxy.command.callback(self, proxy, *args)
+        except Exception as error:
+            await self.cog_command_error(proxy, error)
+
+    async def send_outputs(self, send, outputs):
+        # Embeds are grouped in as few messages as possible
+        embeds = []
+        for content, options in outputs:
+            embed = options.get("embed")
+            if embed and not content and len(options) == 1:
+                if len(embeds) == DISCORD_EMBED_LIMIT or sum(map(len, embeds), len(embed)) > DISCORD_EMBED_SIZE:
+                    await send(embeds=embeds)
+                    embeds = []
+                embeds.append(embed)
+                continue
+            if embeds:
+                await send(embeds=embeds)
+                embeds = []
+            await send(content, **options)
+        if embeds:
+            await send(embeds=embeds)
+
+    async def complete_players(self, ctx):
+        # Only the last target is completed, the previous ones are kept as typed
+        previous, _, current = (ctx.value or "").rpartition(" ")
+        query = User.select(User.name).where(
+            User.guild_id == ctx.interaction.guild_id,
+            User.character_id.is_null(False),
+            User.name.contains(current),
+        )
+        names = [user.name for user in query.order_by(User.name).limit(25)]
+        if current.startswith("@") or not current:
+            query = Creature.select(Creature.squad).distinct().where(Creature.guild_id == ctx.interaction.guild_id)
+            names += [f"@{c.squad}" for c in query.where(Creature.squad.contains(current[1:])).limit(25)]
+        return [f"{previous} {quote(name)}".strip() for name in names][:25]
+
+    async def complete_stats(self, ctx):
+        return [stats for stats in sorted(set(self.STATS.values())) if (ctx.value or "").lower() in stats]
+
+    async def complete_damages(self, ctx):
+        return [damage for damage in sorted(set(self.DAMAGES.values())) if (ctx.value or "").lower() in damage]
+
+    async def complete_body_parts(self, ctx):
+        return [part for part in sorted(set(self.BODY_PARTS.values())) if (ctx.value or "").lower() in part]
+
+    async def complete_channels(self, ctx):
+        if not ctx.interaction.guild:
+            return []
+        names = self.get_index(ctx.interaction.guild).names
+        return [name for name in sorted(names) if (ctx.value or "").lower() in name]
+
+    async def invoke_slash(self, ctx, name, *args, ephemeral=False):
+        # The interaction is acknowledged at once, the text command then runs and its results are edited in
+        await ctx.defer(ephemeral=ephemeral)
+        proxy = ProxyContext(ctx, self.bot.get_command(name), " ".join((f"/{name}", *map(quote, args))), prefix="/")
+        if self.recorder:
+            self.recorder.command(ctx, proxy.message.content)
+        await self.run_proxy(proxy, args)
+        responded = False
+
+        async def respond(content=None, **options):
+            nonlocal responded
+            if responded:
+                await ctx.followup.send(content, **options)
+            else:
+                await ctx.edit(content=content, **options)
+                responded = True
+
+        await self.send_outputs(respond, proxy.channel.outputs)
+        if not responded:
+            await ctx.delete()
+
+    @slash_command(name="sheet", description="Affiche l'état d'un personnage.")
+    @guild_only()
+    async def sheet_slash(
+        self,
+        ctx,
+        player: Option(str, "Nom du joueur (MJ uniquement)", autocomplete=complete_players, default=None),
+        show: Option(bool, "Afficher dans le canal ?", default=False),
+    ):
+        await self.invoke_slash(ctx, "sheet", *to_arguments(*filter(None, [player]), show=show))
+
+    @slash_command(name="roll", description="Réalise un jet de compétence ou de S.P.E.C.I.A.L.")
+    @is_game_master()
+    async def roll_slash(
+        self,
+        ctx,
+        stats: Option(str, "Nom de la statistique", autocomplete=complete_stats),
+        players: Option(str, TARGETS_HELP, autocomplete=complete_players),
+        modifier: Option(int, "Modificateur", default=0),
+        xp: Option(bool, "Expérience ?", default=True),
+        reason: Option(str, "Explication", default=""),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        arguments = to_arguments(stats, *split_arguments(players), modifier=modifier, xp=not xp, reason=reason, tag=tag)
+        await self.invoke_slash(ctx, "roll", *arguments)
+
+    @slash_command(name="damage", description="Inflige des dégâts à un ou plusieurs joueurs.")
+    @is_game_master()
+    async def damage_slash(
+        self,
+        ctx,
+        min_damage: Option(int, "Dégâts minimals"),
+        max_damage: Option(int, "Dégâts maximals"),
+        players: Option(str, TARGETS_HELP, autocomplete=complete_players),
+        raw_damage: Option(int, "Dégâts bruts", default=0),
+        damage_type: Option(str, "Type de dégâts", name="type", autocomplete=complete_damages, default="normal"),
+        part: Option(str, "Partie du corps touchée", autocomplete=complete_body_parts, default=None),
+        threshold: Option(int, "Modificateur d'absorption", default=0),
+        resistance: Option(int, "Modificateur de résistance", default=0),
+        simulation: Option(bool, "Simulation ?", default=False),
+        reason: Option(str, "Explication", default=""),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        arguments = to_arguments(
+            min_damage,
+            max_damage,
+            raw_damage,
+            type=damage_type,
+            part=part,
+            threshold=threshold,
+            resistance=resistance,
+            simulation=simulation,
+            reason=reason,
+            tag=tag,
+        )
+        await self.invoke_slash(ctx, "damage", *arguments, *split_arguments(players))
+
+    @slash_command(name="xp", description="Ajoute de l'expérience à un ou plusieurs personnages.")
+    @is_game_master()
+    async def xp_slash(
+        self,
+        ctx,
+        amount: Option(int, "Quantité d'expérience"),
+        players: Option(str, TARGETS_HELP, autocomplete=complete_players),
+        reason: Option(str, "Raison", default=""),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        await self.invoke_slash(ctx, "xp", *to_arguments(amount, *split_arguments(players), reason=reason, tag=tag))
+
+    @slash_command(name="odds", description="Estime localement les chances de réussite ou les dégâts subis.")
+    @is_game_master()
+    async def odds_slash(
+        self,
+        ctx,
+        players: Option(str, TARGETS_HELP, autocomplete=complete_players),
+        stats: Option(str, "Nom de la statistique", autocomplete=complete_stats, default=None),
+        modifier: Option(int, "Modificateur", default=0),
+        min_damage: Option(int, "Dégâts minimals", default=None),
+        max_damage: Option(int, "Dégâts maximals", default=None),
+        raw_damage: Option(int, "Dégâts bruts", default=0),
+        damage_type: Option(str, "Type de dégâts", name="type", autocomplete=complete_damages, default="normal"),
+        trials: Option(int, "Nombre de simulations", default=10000),
+    ):
+        damage = (min_damage, max_damage, raw_damage) if min_damage is not None and max_damage is not None else None
+        arguments = to_arguments(
+            *split_arguments(players), stats=stats, modifier=modifier, damage=damage, type=damage_type, trials=trials
+        )
+        await self.invoke_slash(ctx, "odds", *arguments)
+
+    @slash_command(name="time", description="Avance dans le temps et passe éventuellement au tour suivant.")
+    @is_game_master()
+    async def time_slash(
+        self,
+        ctx,
+        seconds: Option(int, "Nombre de secondes écoulées", default=0),
+        minutes: Option(int, "Nombre de minutes écoulées", default=0),
+        hours: Option(int, "Nombre d'heures écoulées", default=0),
+        sleep: Option(bool, "Repos ?", default=False),
+        turn: Option(bool, "Tour suivant ?", default=False),
+        all_campaigns: Option(bool, "Pour toutes les campagnes ?", name="all", default=False),
+        reason: Option(str, "Raison", default=""),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        arguments = to_arguments(
+            seconds=seconds,
+            minutes=minutes,
+            hours=hours,
+            sleep=sleep,
+            turn=turn,
+            all=all_campaigns,
+            reason=reason,
+            tag=tag,
+        )
+        await self.invoke_slash(ctx, "time", *arguments)
+
+    @slash_command(name="move", description="Déplace un ou plusieurs joueurs dans un autre canal.")
+    @is_game_master()
+    async def move_slash(
+        self,
+        ctx,
+        channel: Option(str, "Nom du canal de destination", autocomplete=complete_channels),
+        players: Option(str, "Nom des joueurs", autocomplete=complete_players),
+        topic: Option(str, "Description du canal", default=None),
+        date: Option(str, "Date", default=None),
+    ):
+        arguments = to_arguments(channel, *split_arguments(players), topic=topic, date=date)
+        await self.invoke_slash(ctx, "move", *arguments)
+
+    @slash_command(name="new", description="Crée un nouveau personnage avec les statistiques choisies.")
+    @guild_only()
+    async def new_slash(
+        self,
+        ctx,
+        strength: Option(int, "Force (entre 1 et 10)", min_value=1, max_value=10),
+        perception: Option(int, "Perception (entre 1 et 10)", min_value=1, max_value=10),
+        endurance: Option(int, "Endurance (entre 1 et 10)", min_value=1, max_value=10),
+        charisma: Option(int, "Charisme (entre 1 et 10)", min_value=1, max_value=10),
+        intelligence: Option(int, "Intelligence (entre 1 et 10)", min_value=1, max_value=10),
+        agility: Option(int, "Agilité (entre 1 et 10)", min_value=1, max_value=10),
+        luck: Option(int, "Chance (entre 1 et 10)", min_value=1, max_value=10),
+        tags: Option(str, "Spécialités (maximum 3)", default=""),
+        user: Option(str, "Utilisateur (MJ uniquement)", autocomplete=complete_players, default=None),
+    ):
+        arguments = to_arguments(
+            strength,
+            perception,
+            endurance,
+            charisma,
+            intelligence,
+            agility,
+            luck,
+            tag=split_arguments(tags),
+            user=user,
+        )
+        await self.invoke_slash(ctx, "new", *arguments)
+
+    @slash_command(name="link", description="Retourne un lien vers votre fiche de personnage.")
+    @guild_only()
+    async def link_slash(self, ctx):
+        await self.invoke_slash(ctx, "link")
+
+    @slash_command(name="fight", description="Fait s'affronter deux joueurs entre eux.")
+    @is_game_master()
+    async def fight_slash(
+        self,
+        ctx,
+        attacker: Option(str, "Joueur attaquant", autocomplete=complete_players),
+        defender: Option(str, "Joueur défenseur", autocomplete=complete_players),
+        target_range: Option(int, "Distance entre les deux joueurs", name="range", default=1),
+        part: Option(str, "Partie du corps touchée", autocomplete=complete_body_parts, default="torso"),
+        modifier: Option(int, "Modificateur de précision", default=0),
+        action: Option(bool, "Action ?", default=False),
+        weapon: Option(str, "Type d'arme", default="primary"),
+        success: Option(bool, "Succès ?", default=False),
+        critical: Option(bool, "Critique ?", default=False),
+        raw: Option(bool, "Dégâts bruts ?", default=False),
+        simulation: Option(bool, "Simulation ?", default=False),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        arguments = to_arguments(
+            attacker,
+            defender,
+            range=target_range,
+            part=part,
+            modifier=modifier,
+            action=action,
+            weapon=weapon,
+            success=success,
+            critical=critical,
+            raw=raw,
+            simulation=simulation,
+            tag=tag,
+        )
+        await self.invoke_slash(ctx, "fight", *arguments)
+
+    @slash_command(name="give", description="Donne un ou plusieurs objets à un personnage donné.")
+    @is_game_master()
+    async def give_slash(
+        self,
+        ctx,
+        item: Option(str, "Nom ou identifiant de l'objet"),
+        player: Option(str, "Nom du joueur", autocomplete=complete_players),
+        quantity: Option(int, "Nombre d'objets", default=1),
+        condition: Option(int, "Etat de l'objet", default=100),
+        image: Option(str, "Image de l'objet", default=None),
+        silent: Option(bool, "Pas de notification", default=False),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        arguments = to_arguments(
+            item, player, quantity=quantity, condition=condition, image=image, silent=silent, tag=tag
+        )
+        await self.invoke_slash(ctx, "give", *arguments)
+
+    @slash_command(name="open", description="Ouvre un butin avec éventuellement un personnage donné.")
+    @is_game_master()
+    async def open_slash(
+        self,
+        ctx,
+        loot: Option(str, "Nom ou identifiant du butin"),
+        player: Option(str, "Joueur", autocomplete=complete_players, default=None),
+        silent: Option(bool, "Pas de notification", default=False),
+        tag: Option(bool, "Mentionner ?", default=False),
+    ):
+        await self.invoke_slash(ctx, "open", *to_arguments(loot, player=player, silent=silent, tag=tag))
+
+    @slash_command(name="copy", description="Copie un ou plusieurs personnages dans la campagne courante.")
+    @is_game_master()
+    async def copy_slash(
+        self,
+        ctx,
+        character: Option(int, "Identifiant du personnage"),
+        name: Option(str, "Nouveau nom du personnage", default=""),
+        count: Option(int, "Nombre de personnages", default=1),
+        squad: Option(str, "Nom de l'escouade (par défaut : le nom)", default=""),
+    ):
+        await self.invoke_slash(ctx, "copy", *to_arguments(character, name=name, count=count, squad=squad))
+
+    @slash_command(name="say", description="Ouvre une fenêtre de dialogue riche.")
+    @is_game_master()
+    async def say_slash(
+        self,
+        ctx,
+        text: Option(str, "Texte du dialogue"),
+        title: Option(str, "Titre du dialogue", default=None),
+        portrait: Option(str, "URL de la miniature", default=None),
+        image: Option(str, "URL de l'image", default=None),
+        color: Option(str, "Couleur du dialogue", default=None),
+    ):
+        arguments = to_arguments(text, title=title, portrait=portrait, image=image, color=color)
+        await self.invoke_slash(ctx, "say", *arguments)
+
+    @slash_command(name="purge", description="Purge les messages du canal et les envoie aux joueurs présents.")
+    @is_game_master()
+    async def purge_slash(self, ctx):
+        # The response is ephemeral so that it is not deleted along with the messages of the channel
+        await self.invoke_slash(ctx, "purge", ephemeral=True)
+
+    @slash_command(name="jobs", description="Affiche, reprend ou annule les opérations en cours d'exécution.")
+    @is_game_master()
+    async def jobs_slash(
+        self,
+        ctx,
+        retry: Option(int, "Reprendre une opération échouée", default=None),
+        cancel: Option(int, "Annuler une opération", default=None),
+    ):
+        await self.invoke_slash(ctx, "jobs", *to_arguments(retry=retry, cancel=cancel))
+
+    @slash_command(name="config", description="Affiche ou modifie la configuration du bot pour ce serveur.")
+    @guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def config_slash(
+        self,
+        ctx,
+        admin: Option(str, "Rôle des maîtres du jeu", default=None),
+        player: Option(str, "Rôle des joueurs", default=None),
+        category: Option(str, "Catégorie des canaux privés des joueurs", default=None),
+        world: Option(str, "Catégorie des canaux du monde", default=None),
+        campaign: Option(int, "Campagne des nouveaux personnages", default=None),
+    ):
+        arguments = to_arguments(admin=admin, player=player, category=category, world=world, campaign=campaign)
+        await self.invoke_slash(ctx, "config", *arguments)
+
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
         if not after.bot:
-            await self.get_user(after)
+            self.scheduler.defer(("user", after.id), self.get_user, after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.indices.pop(guild.id, None)
+        self.configs.pop(guild.id, None)
+        for cache in (self.users, self.channels):
+            for key in [key for key, record in cache.items() if record.guild_id == guild.id]:
+                del cache[key]
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        if index := self.indices.get(role.guild.id):
+            index.add_role(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if index := self.indices.get(after.guild.id):
+            index.remove_role(before)
+            index.add_role(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if index := self.indices.get(role.guild.id):
+            index.remove_role(role)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        if index := self.indices.get(channel.guild.id):
+            index.add_channel(channel)
 
     @commands.Cog.listener()
     async def on_guild_channel_update(self, before, after):
+        if index := self.indices.get(after.guild.id):
+            index.remove_channel(before)
+            index.add_channel(after)
         if Channel.get_or_none(Channel.id == after.id):
             await self.get_channel(after)
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
+        if index := self.indices.get(channel.guild.id):
+            index.remove_channel(channel)
         _channel = Channel.get_or_none(Channel.id == channel.id)
         if _channel:
-            await self.request(f"campaign/{_channel.campaign_id}/", method="delete")
-            User.update(channel_id=None).where(User.channel_id == _channel.id).execute()
-            _channel.delete_instance()
+            async with self.locks(("campaign", _channel.campaign_id), ("channel", _channel.id)):
+                await self.request(f"campaign/{_channel.campaign_id}/", method="delete")
+                instances = list(User.select(User.guild_id, User.id).where(User.channel_id == _channel.id))
+                User.update(channel_id=None).where(User.channel_id == _channel.id).execute()
+                for instance in instances:
+                    if _user := self.users.get((instance.guild_id, instance.id)):
+                        _user.channel_id = None
+                    store.publish(User, instance.id)
+                _channel.delete_instance()
+                self.channels.pop(_channel.id, None)
+                store.publish(Channel, _channel.id)
+
+    def cog_unload(self):
+        if self.recorder:
+            self.recorder.close()
+
+    async def cog_before_invoke(self, ctx):
+        self.scheduler.begin()
+        # Slash commands are recorded with the text command they run
+        if self.recorder and isinstance(ctx, commands.Context):
+            self.recorder.command(ctx, ctx.message.content)
+
+    async def cog_after_invoke(self, ctx):
+        self.scheduler.end()
 
     async def cog_command_error(self, ctx, error):
-        if hasattr(ctx.message.channel, "name"):
-            await ctx.author.send(f"⚠️ **Erreur :** {error} (`{ctx.message.content}` on `{ctx.message.channel.name}`)")
-            logger.error(f"[{ctx.message.channel.name}] {error} ({ctx.message.content})")
+        # Slash commands have no message, and have to be answered when they fail before being deferred
+        content = ctx.message.content if ctx.message else f"/{ctx.command.qualified_name}"
+        channel = ctx.message.channel if ctx.message else ctx.channel
+        if isinstance(getattr(error, "original", error), BackendUnavailable):
+            message = f"🔌 **Serveur indisponible :** la commande `{content}` n'a pas pu aboutir, réessayez plus tard."
+            if isinstance(ctx, ApplicationContext) and not ctx.response.is_done():
+                await ctx.respond(message, ephemeral=True)
+            else:
+                await ctx.author.send(message)
+            logger.warning(f"Backend unavailable ({content})")
+            return
+        if isinstance(ctx, ApplicationContext) and not ctx.response.is_done():
+            await ctx.respond(f"⚠️ **Erreur :** {error}", ephemeral=True)
+            logger.error(f"{error} ({content})")
+        elif hasattr(channel, "name"):
+            await ctx.author.send(f"⚠️ **Erreur :** {error} (`{content}` on `{channel.name}`)")
+            logger.error(f"[{channel.name}] {error} ({content})")
         else:
-            await ctx.author.send(f"⚠️ **Erreur :** {error} (`{ctx.message.content}`)")
-            logger.error(f"{error} ({ctx.message.content})")
+            await ctx.author.send(f"⚠️ **Erreur :** {error} (`{content}`)")
+            logger.error(f"{error} ({content})")
         import traceback
 
         traceback.print_exception(error)
@@ -1225,7 +2664,7 @@ class Fallout(commands.Cog):
     async def get_character_url(self, user):
         if not user.player_id:
             return ""
-        ret = await self.request(f"common/token/?all=1&user_id={user.player_id}")
+        ret = await self.fetch(f"common/token/?user_id={user.player_id}", limit=1, fields=("key",))
         extra = [f"?character={user.character_id}"] if user.character_id else [""]
         return "/".join([FALLOUT_URL, "token", ret[0]["key"]] + extra)
 
@@ -1233,7 +2672,6 @@ class Fallout(commands.Cog):
         data = dict(
             name=user.name,
             player=user.player_id,
-            campaign=FALLOUT_CAMPAIGN,
             is_player=True,
             has_stats=True,
             has_needs=True,
@@ -1246,141 +2684,705 @@ class Fallout(commands.Cog):
         if ret is None:
             return
         user.character_id = ret["id"]
-        user.save(only=("character_id",))
+        user.save("character_id")
+        self.update_sheet(ret)
+        return user
+
+    def provision(self, _user):
+        _user = self.users.get(_user.key) or _user
+        self.players[_user.id] = _user
+        if not self.provisioner or self.provisioner.done():
+            self.provisioner = asyncio.create_task(self.provision_players())
+
+    async def provision_players(self):
+        semaphore = asyncio.Semaphore(FALLOUT_PROVISION_CONCURRENCY)
+
+        async def proceed(_user):
+            async with semaphore:
+                try:
+                    await self.create_player(_user)
+                except Exception as error:
+                    logger.error(f"Unable to provision player for user '{_user.name}' ({_user.id}): {error}")
+
+        while self.players:
+            users = [self.players.pop(user_id) for user_id in list(self.players)[:FALLOUT_PROVISION_BATCH]]
+            await asyncio.gather(*(proceed(_user) for _user in users))
+
+    async def create_player(self, user):
+        async with self.locks(("provision", user.id)):
+            # The record may be stale, and the player may have been provisioned from another guild
+            query = User.select(User.player_id).where(User.id == user.id, User.player_id.is_null(False))
+            user.player_id = user.player_id or query.scalar()
+            if user.player_id:
+                return user
+            for attempt in range(FALLOUT_PROVISION_RETRIES):
+                try:
+                    ret = await self.request(
+                        "player/",
+                        method="post",
+                        data=dict(
+                            username=user.id,
+                            nickname=user.name,
+                            password=uuid.uuid4().hex,
+                        ),
+                    )
+                except (httpx.HTTPError, BackendUnavailable):
+                    ret = None
+                if ret:
+                    break
+                if attempt + 1 < FALLOUT_PROVISION_RETRIES:
+                    await asyncio.sleep(2**attempt)
+            else:
+                raise Exception(f"Unable to retrieve data from backend.")
+            user.player_id = ret["id"]
+            user.save("player_id")
+            self.players.pop(user.id, None)
         return user
 
-    async def get_user(self, user):
+    async def get_user(self, user, guild=None):
+        # Names and identifiers are only resolved in the given guild
         if isinstance(user, str):
             if user.isdigit():
-                creature = self.creatures.get(user)
+                creature = self.creatures.get(int(user))
                 if not creature:
-                    ret = await self.request(f"character/{user}/")
-                    if ret:
-                        creature = Creature(
-                            id=0,
-                            name=ret["name"],
-                            character_id=ret["id"],
-                            campaign_id=ret["campaign_id"],
-                        )
-                        self.creatures[user] = creature
+                    if instance := Creature.get_or_none(Creature.character_id == int(user)):
+                        creature = CreatureRecord.load(instance, id=0)
+                    elif ret := await self.request(f"character/{user}/", fields=("id", "name", "campaign_id")):
+                        data = dict(character_id=ret["id"], name=ret["name"], campaign_id=ret["campaign_id"])
+                        Creature.insert(**data).on_conflict_ignore().execute()
+                        creature = CreatureRecord(id=0, **data)
+                    if creature:
+                        self.creatures[creature.character_id] = creature
+                if creature and guild and creature.guild_id not in (None, guild.id):
+                    return None
                 return creature
             user_id = self.extract_id(user)
             if user_id:
-                user = self.bot.get_user(user_id)
+                user = await self.query_member(user_id=user_id, guild=guild)
             else:
                 func = lambda u: any(
                     user.lower() in value.lower() for value in (u.nick, u.name, u.display_name) if value
                 )
-                user = utils.find(func, self.bot.get_all_members())
+                members = guild.members if guild else self.bot.get_all_members()
+                user = utils.find(func, members) or await self.query_member(query=user, guild=guild)
         if not user:
             return None
-        _user = self.users.get(user.id)
-        if not _user:
-            _user, created = User.get_or_create(id=user.id, defaults=dict(name=user.nick or user.name))
-        if not _user.player_id:
-            ret = await self.request(
-                "player/",
-                method="post",
-                data=dict(
-                    username=_user.id,
-                    nickname=_user.name,
-                    password=uuid.uuid4().hex,
-                ),
-            )
-            if not ret:
-                raise Exception(f"Unable to retrieve data from backend.")
-            _user.player_id = ret["id"]
-            _user.save(only=("player_id",))
-        if (user.nick or user.name) != _user.name:
-            _user.name = user.nick or user.name
-            _user.save(only=("name",))
+        # Members have their own record in each guild
+        guild = getattr(user, "guild", None) or guild
+        key = (guild.id if guild else 0, user.id)
+        async with self.locks(("user", *key)):
+            _user = self.users.get(key)
+            if not _user:
+                instance, created = User.get_or_create(
+                    id=user.id, guild_id=key[0], defaults=dict(name=user.nick or user.name)
+                )
+                _user = UserRecord.load(instance)
+            if not _user.player_id:
+                self.provision(_user)
+            if (user.nick or user.name) != _user.name:
+                _user.name = user.nick or user.name
+                _user.save("name")
+                self.renames[key] = asyncio.create_task(self.rename_user(_user))
+            self.users[key] = _user
+            return _user
+
+    async def get_targets(self, targets, guild):
+        # Squads and channels are expanded from the indices, other targets are resolved concurrently
+        async def resolve(target):
+            if target.startswith("@"):
+                query = Creature.select().where(Creature.guild_id == guild.id, Creature.squad == normalize(target[1:]))
+                if squad := [self.creatures.get(c.character_id) or CreatureRecord.load(c, id=0) for c in query]:
+                    return squad
+            if target.startswith("<#") and (channel_id := self.extract_id(target)):
+                if getattr(getattr(self.bot.get_channel(channel_id), "guild", None), "id", None) != guild.id:
+                    return []
+                query = User.select().where(User.channel == channel_id, User.character_id.is_null(False))
+                return [self.users.get((guild.id, instance.id)) or UserRecord.load(instance) for instance in query]
+            return [await self.get_user(target, guild)]
+
+        players = {}
+        for group in await asyncio.gather(*map(resolve, targets)):
+            for player in group:
+                if player and player.character_id:
+                    players.setdefault(player.character_id, player)
+        return list(players.values())
+
+    async def dispatch(self, players, action, data):
+        async def call(player):
+            async with self.locks(("character", player.character_id)):
+                return await self.request(f"character/{player.character_id}/{action}/", method="post", data=data)
+
+        # Every target is reported on its own, the calls which succeeded have already been applied
+        results = await asyncio.gather(*map(call, players), return_exceptions=True)
+        # An unavailable backend is reported at once for the whole command
+        if unavailable := next((result for result in results if isinstance(result, BackendUnavailable)), None):
+            raise unavailable
+        for player, result in zip(players, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Unable to {action} character {player.character_id}: {result}")
+        return results
+
+    async def rename_user(self, _user):
+        # Successive renames are debounced, only the most recent one is propagated
+        await asyncio.sleep(FALLOUT_RENAME_DELAY)
+        if self.renames.get(_user.key) is not asyncio.current_task():
+            return
+        async with self.locks(("rename", _user.id)):
+            requests = []
             if _user.player_id:
-                await self.request(
-                    f"player/{_user.player_id}/",
-                    method="patch",
-                    data=dict(nickname=_user.name),
+                requests.append(
+                    self.request(
+                        f"player/{_user.player_id}/", method="patch", data=dict(nickname=_user.name), deferred=True
+                    )
                 )
             if _user.character_id:
-                await self.request(
-                    f"character/{_user.character_id}/",
-                    method="patch",
-                    data=dict(name=_user.name),
+                requests.append(
+                    self.request(
+                        f"character/{_user.character_id}/", method="patch", data=dict(name=_user.name), deferred=True
+                    )
                 )
-            if _user.my_channel_id:
-                channel = self.bot.get_channel(_user.my_channel_id)
-                if channel:
-                    await channel.edit(name=_user.name)
-        _user.user = user
-        self.users[_user.id] = _user
-        return _user
+            await asyncio.gather(*requests)
+            channel = self.bot.get_channel(_user.my_channel_id) if _user.my_channel_id else None
+            if channel:
+                renames = self.channel_renames.setdefault(channel.id, deque(maxlen=DISCORD_RENAME_LIMIT))
+                if len(renames) == renames.maxlen:
+                    await asyncio.sleep(max(renames[0] + DISCORD_RENAME_PERIOD - monotonic(), 0))
+                channel_name = normalize(_user.name)
+                if channel.name != channel_name:
+                    await channel.edit(name=channel_name)
+                    renames.append(monotonic())
+        if self.renames.get(_user.key) is asyncio.current_task():
+            del self.renames[_user.key]
+
+    async def query_member(self, query=None, user_id=None, guild=None):
+        for guild in [guild] if guild else self.bot.guilds:
+            member = guild.get_member(user_id) if user_id else None
+            # Members are not cached in low footprint mode and have to be requested from the gateway
+            if not member and DISCORD_LOW_FOOTPRINT:
+                members = await guild.query_members(query, user_ids=[user_id] if user_id else None, limit=1)
+                member = members[0] if members else None
+            if member:
+                return member
+        return None
+
+    async def get_member(self, _user):
+        guild = self.bot.get_guild(_user.guild_id) if _user.guild_id else None
+        if not guild:
+            return self.bot.get_user(_user.id)
+        try:
+            return guild.get_member(_user.id) or await guild.fetch_member(_user.id)
+        except NotFound:
+            return None
 
     async def get_channel(self, channel, user=None, date=None):
-        date = date or FALLOUT_DATE
+        date = date or get_start_date()
         if isinstance(channel, str):
             channel_id = self.extract_id(channel)
             if channel_id:
                 channel = self.bot.get_channel(channel_id)
             else:
-                channel = utils.find(lambda c: channel.lower() == c.name.lower(), self.bot.get_all_channels())
+                name = channel.lower()
+                channel = next(filter(None, (self.get_index(g).names.get(name) for g in self.bot.guilds)), None)
         if not channel:
             return None
+        async with self.locks(("channel", channel.id)):
+            _channel = self.channels.get(channel.id)
+            if not _channel:
+                instance, created = Channel.get_or_create(
+                    id=channel.id, defaults=dict(name=channel.name, date=date, guild_id=channel.guild.id)
+                )
+                _channel = ChannelRecord.load(instance)
+                if _channel.guild_id != channel.guild.id:
+                    _channel.guild_id = channel.guild.id
+                    _channel.save("guild_id")
+            channel_name = channel.name.replace("#", "").replace("-", " ").replace("_", " ").title()
+            if not _channel.campaign_id:
+                ret = await self.request(
+                    "campaign/",
+                    method="post",
+                    data=dict(
+                        name=channel_name,
+                        game_master=(await self.create_player(user)).player_id if user else None,
+                        description=channel.topic or "",
+                        start_game_date=get_start_date().isoformat(),
+                        current_game_date=date.isoformat(),
+                    ),
+                )
+                _channel.campaign_id = ret["id"]
+                _channel.save("campaign_id")
+            elif not self.listening or not _channel.refreshed or monotonic() - _channel.refreshed > FALLOUT_CACHE_TTL:
+                # Campaigns are only polled when changes are not pushed by the backend
+                ret = await self.request(f"campaign/{_channel.campaign_id}/", fields=("current_game_date",))
+                _channel.date = parse_date(ret["current_game_date"])
+                _channel.save("date")
+                _channel.refreshed = monotonic()
+            if _channel.name != channel.name or _channel.topic != channel.topic:
+                _channel.name, _channel.topic = channel.name, channel.topic
+                _channel.save("name", "topic")
+                await self.request(
+                    f"campaign/{_channel.campaign_id}/",
+                    method="patch",
+                    data=dict(name=channel_name, description=channel.topic or ""),
+                    deferred=True,
+                )
+            self.channels[_channel.id] = _channel
+            return _channel
+
+    def update_sheet(self, character):
+        if character and character.get("id"):
+            self.sheets[character["id"]] = character
+
+    def invalidate_sheets(self, endpoint):
+        # Any write may change characters, the up-to-date sheet is usually returned by the call itself
+        if match := re.match(r"character/(\d+)/", endpoint):
+            self.sheets.pop(int(match[1]), None)
+        elif match := re.match(r"campaign/(\d+)/", endpoint):
+            campaign_id = int(match[1])
+            for character_id, sheet in list(self.sheets.items()):
+                if campaign_id in (sheet.get("campaign"), sheet.get("campaign_id")):
+                    del self.sheets[character_id]
+
+    async def get_sheet(self, character_id):
+        if sheet := self.sheets.get(character_id):
+            return sheet
+        ret = await self.request(f"character/{character_id}/")
+        self.update_sheet(ret)
+        return ret
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.session.stream("GET", FALLOUT_EVENTS, timeout=None) as resp:
+                    resp.raise_for_status()
+                    # Changes may have been missed while disconnected
+                    for _channel in self.channels.values():
+                        _channel.refreshed = None
+                    self.listening = True
+                    logger.info(f"Listening to backend events on {FALLOUT_EVENTS}")
+                    lines = []
+                    async for line in resp.aiter_lines():
+                        if line.startswith("data:"):
+                            lines.append(line[5:].strip())
+                        elif not line and lines:
+                            self.apply_event("\n".join(lines))
+                            lines = []
+            except httpx.HTTPError as error:
+                logger.warning(f"Backend events interrupted: {error}")
+            finally:
+                self.listening = False
+            await asyncio.sleep(FALLOUT_EVENTS_RETRY)
+
+    def enqueue(self, kind, label, author, keys, steps):
+        instance = Job.create(
+            kind=kind, label=label, author_id=author.id, data=json.dumps(dict(keys=keys, steps=steps))
+        )
+        self.jobs.put_nowait(instance.id)
+        return instance.id
+
+    async def work(self):
+        while True:
+            job_id = await self.jobs.get()
+            instance = Job.get_or_none(Job.id == job_id)
+            if not instance or instance.state in ("done", "failed"):
+                continue
+            # Jobs are claimed before being run so that another process cannot run them at the same time
+            now = datetime.now()
+            claimed = Job.update(state="running", updated=now).where(Job.id == job_id, Job.updated == instance.updated)
+            if not claimed.execute():
+                continue
+            self.running.add(job_id)
+            try:
+                await self.run_job(JobRecord.load(instance, state="running", updated=now))
+            except Exception as error:
+                # The job is marked as failed so that it can be retried instead of staying claimed for good
+                Job.update(state="failed", error=str(error)).where(Job.id == job_id).execute()
+                logger.error(f"Job #{job_id} ({instance.kind}) crashed: {error}")
+            finally:
+                self.running.discard(job_id)
+
+    def requeue_stale_jobs(self):
+        # Jobs left running by a crashed process are taken over once they have not progressed for too long
+        stale = Job.state == "running", Job.updated < datetime.now() - timedelta(seconds=FALLOUT_JOB_TIMEOUT)
+        for job in Job.select(Job.id).where(*stale).order_by(Job.id):
+            if job.id not in self.running:
+                logger.warning(f"Job #{job.id} is stale, taking it over")
+                self.jobs.put_nowait(job.id)
+
+    async def notify(self, job, send, content):
+        # Progress messages are best effort, closed direct messages must not stop the job
+        try:
+            return await send(content=content)
+        except HTTPException as error:
+            logger.warning(f"Unable to report progress of job #{job.id}: {error}")
+
+    async def run_job(self, job):
+        total = len(job.steps)
+        author = self.bot.get_user(job.author_id) if job.author_id else None
+        progress = f"⏳ {job.label} : {job.position}/{total} étapes."
+        message = await self.notify(job, author.send, progress) if author else None
+        edited = monotonic()
+        async with self.locks(*map(tuple, job.keys)):
+            while job.position < total:
+                name, params = job.steps[job.position]
+                try:
+                    await getattr(self, f"step_{name}")(job, params)
+                except Exception as error:
+                    job.state, job.error = "failed", str(error)
+                    job.checkpoint("state", "error")
+                    logger.error(f"Job #{job.id} ({job.kind}) failed at step {job.position + 1}/{total}: {error}")
+                    if author:
+                        await self.notify(
+                            job,
+                            author.send,
+                            f"⚠️ {job.label} : échec à l'étape {job.position + 1}/{total} ({error}), "
+                            f"utilisez `{OP}jobs --retry {job.id}` pour reprendre.",
+                        )
+                    return
+                job.position += 1
+                job.checkpoint()
+                # Progress is edited at most once every few seconds to stay below Discord rate limits
+                if message and job.position < total and monotonic() - edited > 2:
+                    await self.notify(job, message.edit, f"⏳ {job.label} : {job.position}/{total} étapes.")
+                    edited = monotonic()
+        job.state = "done"
+        job.checkpoint("state")
+        if message:
+            await self.notify(job, message.edit, f"✅ {job.label} : terminé ({total} étapes).")
+
+    async def purge_messages(self, channel):
+        # Only messages posted since the previous purge are deleted, history is not scanned when there are none
         _channel = self.channels.get(channel.id)
-        if not _channel:
-            _channel, created = Channel.get_or_create(id=channel.id, defaults=dict(name=channel.name, date=date))
-        channel_name = channel.name.replace("#", "").replace("-", " ").replace("_", " ").title()
-        if not _channel.campaign_id:
-            ret = await self.request(
-                "campaign/",
-                method="post",
-                data=dict(
-                    name=channel_name,
-                    game_master=user.player_id if user else None,
-                    description=channel.topic or "",
-                    start_game_date=FALLOUT_DATE.isoformat(),
-                    current_game_date=date.isoformat(),
-                ),
-            )
-            _channel.campaign_id = ret["id"]
-            _channel.save(only=("campaign_id",))
+        if not _channel and (instance := Channel.get_or_none(Channel.id == channel.id)):
+            _channel = ChannelRecord.load(instance, guild_id=channel.guild.id)
+        purged_id = _channel.purged_id if _channel else None
+        last_id = channel.last_message_id
+        if purged_id and (not last_id or last_id <= purged_id):
+            return []
+        # Without a previous purge, only the most recent messages are deleted as before
+        if purged_id:
+            deleted_messages = await channel.purge(limit=None, after=Object(id=purged_id))
         else:
-            ret = await self.request(f"campaign/{_channel.campaign_id}/", method="get")
-            _channel.date = parse_date(ret["current_game_date"])
-            _channel.save(only=("date",))
-        if _channel.name != channel.name or _channel.topic != channel.topic:
-            _channel.name, _channel.topic = channel.name, channel.topic
-            _channel.save(
-                only=(
-                    "name",
-                    "topic",
-                )
-            )
+            deleted_messages = await channel.purge(limit=100)
+        if _channel:
+            _channel.purged_id = max([last_id or 0, *(message.id for message in deleted_messages)])
+            _channel.save("purged_id")
+        return deleted_messages
+
+    def load_user(self, guild_id, user_id):
+        return self.users.get((guild_id, user_id)) or UserRecord.load(User.get_by_id((guild_id, user_id)))
+
+    def load_channel(self, channel_id):
+        return self.channels.get(channel_id) or ChannelRecord.load(Channel.get_by_id(channel_id))
+
+    async def step_sync_date(self, job, params):
+        # Channels are already locked by the job, the records are loaded without get_channel
+        _old_channel, _new_channel = map(self.load_channel, (params["date_channel_id"], params["channel_id"]))
+        players_in_channel = User.select().where(User.channel == _new_channel.id)
+        if players_in_channel.count() == 0 and _new_channel.date != _old_channel.date:
+            _new_channel.date = _old_channel.date
+            _new_channel.save("date")
             await self.request(
-                f"campaign/{_channel.campaign_id}/",
+                f"campaign/{_new_channel.campaign_id}/",
                 method="patch",
-                data=dict(name=channel_name, description=channel.topic or ""),
+                data=dict(
+                    start_game_date=_new_channel.date.isoformat(), current_game_date=_new_channel.date.isoformat()
+                ),
+                deferred=True,
             )
-        _channel.channel = channel
-        self.channels[_channel.id] = _channel
-        return _channel
 
-    async def request(self, endpoint, data=None, method=None, **options):
+    async def step_purge_channel(self, job, params):
+        new_channel = self.bot.get_channel(params["channel_id"])
+        if not new_channel:
+            return
+        players_in_channel = User.select().where(User.channel == new_channel.id)
+        deleted_messages = await self.purge_messages(new_channel)
+        if not deleted_messages:
+            return
+        transcript = await chat_exporter.raw_export(new_channel, deleted_messages, set_timezone="Europe/Paris")
+        if not transcript:
+            return
+        for player in players_in_channel:
+            if not player.my_channel_id:
+                continue
+            channel = self.bot.get_channel(player.my_channel_id)
+            if channel:
+                file = File(io.BytesIO(transcript.encode()), filename=f"{new_channel.name}.html")
+                await channel.send(
+                    f"🚪 Un ou plusieurs joueurs sont entrés dans **#{new_channel.name}**, "
+                    f"les messages du canal ont été purgés par soucis de discrétion.\n"
+                    f"⌚ Vous pouvez retrouver l'historique des messages ci-dessous :",
+                    file=file,
+                )
+
+    async def step_move_player(self, job, params):
+        new_channel = self.bot.get_channel(params["channel_id"])
+        # Jobs queued before users were partitioned by guild only know the destination channel
+        player = self.load_user(params.get("guild_id") or new_channel.guild.id, params["user_id"])
+        old_channel = self.bot.get_channel(params["old_channel_id"]) if params["old_channel_id"] else None
+        if player.channel_id != params["channel_id"]:
+            if old_channel and new_channel and player.my_channel_id:
+                channel = self.bot.get_channel(player.my_channel_id)
+                transcript = await chat_exporter.export(old_channel, set_timezone="Europe/Paris")
+                if channel and transcript:
+                    file = File(io.BytesIO(transcript.encode()), filename=f"{old_channel.name}.html")
+                    await channel.send(
+                        f"🚪 Vous avez été déplacé de **#{old_channel.name}** "
+                        f"vers **#{new_channel.name}**.\n"
+                        f"⌚ Vous pouvez retrouver l'historique des messages ci-dessous :",
+                        file=file,
+                    )
+            player.channel_id = params["channel_id"]
+            player.save("channel_id")
+        await self.request(
+            f"character/{player.character_id}/",
+            method="patch",
+            data=dict(campaign=params["campaign_id"]),
+            deferred=True,
+        )
+
+    async def step_update_permissions(self, job, params):
+        new_channel = self.bot.get_channel(params["channel_id"])
+        if not new_channel:
+            return
+        # Permission overwrites are computed per channel and applied with a single edit
+        overwrites = {new_channel.id: get_overwrites(new_channel)}
+        for user_id, old_channel_id in params["moves"]:
+            member = await self.get_member(self.load_user(new_channel.guild.id, user_id))
+            if old_channel := self.bot.get_channel(old_channel_id) if old_channel_id else None:
+                overwrites.setdefault(old_channel.id, get_overwrites(old_channel)).pop(Object(id=user_id), None)
+            if member:
+                overwrites[new_channel.id][Object(id=member.id)] = PermissionOverwrite(read_messages=True)
+        gm_role = self.get_index(new_channel.guild).roles.get(self.get_config(new_channel.guild).admin_role)
+        overwrites[new_channel.id][gm_role] = PermissionOverwrite(read_messages=True)
+        for channel_id, channel_overwrites in overwrites.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel and channel_overwrites != get_overwrites(channel):
+                await channel.edit(overwrites=channel_overwrites)
+
+    async def step_announce_move(self, job, params):
+        leaving_users = {}
+        for user_id, old_channel_id in params["moves"]:
+            if old_channel_id:
+                leaving_users.setdefault(old_channel_id, []).append(user_id)
+        for channel_id, user_ids in leaving_users.items():
+            old_channel = self.bot.get_channel(channel_id)
+            if not old_channel:
+                continue
+            user_names = ", ".join([f"<@{user_id}>" for user_id in user_ids])
+            if len(user_ids) > 1:
+                await old_channel.send(f"📤 {user_names} partent de <#{old_channel.id}>.")
+                continue
+            await old_channel.send(f"📤 {user_names} part de <#{old_channel.id}>.")
+        new_channel = self.bot.get_channel(params["channel_id"])
+        if not new_channel:
+            return
+        user_names = ", ".join([f"<@{user_id}>" for user_id, old_channel_id in params["moves"]])
+        if len(params["moves"]) > 1:
+            await new_channel.send(f"📥 {user_names} arrivent dans <#{new_channel.id}>.")
+            return
+        await new_channel.send(f"📥 {user_names} arrive dans <#{new_channel.id}>.")
+
+    async def step_advance_time(self, job, params):
+        # The date seen before moving forward is saved so that a resumed step is not applied twice
+        ret = await self.request(f"campaign/{params['campaign_id']}/", fields=("current_game_date",))
+        if ret is None:
+            raise Exception(f"Unable to retrieve data from backend.")
+        if params.get("date", ret["current_game_date"]) != ret["current_game_date"]:
+            return
+        params["date"] = ret["current_game_date"]
+        job.checkpoint()
+        if channel := self.bot.get_channel(params["channel_id"]):
+            await self.advance_time(channel, params["campaign_id"], params["options"])
+
+    async def advance_time(self, channel, campaign_id, options):
+        hours, minutes, seconds = options["hours"], options["minutes"], options["seconds"]
+        elapsed = int(timedelta(seconds=seconds, minutes=minutes, hours=hours).total_seconds())
+        data = dict(resting=options["resting"], reset=not options["turn"], seconds=elapsed)
+        async with self.locks(("campaign", campaign_id)):
+            ret = await self.request(f"campaign/{campaign_id}/next/", method="post", data=data)
+        if ret is None:
+            return
+        date = parse_date(ret["campaign"]["current_game_date"])
+        messages = []
+        if options["reason"]:
+            messages.append(f"> {options['reason']}\n")
+        if elapsed:
+            messages.append(f"⌛ **{hours:02}:{minutes:02}:{seconds:02}** se sont écoulées !")
+        messages.append(f"📅 Nous sommes désormais le **{date:%A %d %B %Y}** et il est **{date:%H:%M:%S}**.")
+        if ret.get("character"):
+            try:
+                _user = User.get(User.character_id == ret["character"]["id"])
+                who = f"<@{_user.id}>" if options["tag"] else f"**{ret["character"]["name"]}**"
+                messages.append(f"🔁 C'est désormais au tour de {who}.")
+            except:
+                character = ret["character"]
+                messages.append(f"🔁 C'est désormais au tour de **{character['name']}** ({character['id']}).")
+        for damage in ret.get("damages", []):
+            messages.append(f"> {ret['icon']}  **{damage['character']['name']}** a reçu **{ret['long_label']}**")
+        embed = Embed(title=f"⏰ Le temps passe...", description="\n".join(messages))
+        await channel.send(embed=embed)
+
+    async def synchronize(self):
+        # Records changed by other processes are evicted from the caches and reloaded on next use
+        caches = {"channel": self.channels, "guild": self.configs, "creature": self.creatures}
+        scanned = monotonic()
+        while True:
+            try:
+                for model, key in store.poll():
+                    if model == "user":
+                        # Users are cached by guild, the records of the member are evicted in all of them
+                        for guild in self.bot.guilds:
+                            self.users.pop((guild.id, key), None)
+                    elif (cache := caches.get(model)) is not None:
+                        cache.pop(key, None)
+                if monotonic() - scanned > FALLOUT_JOB_TIMEOUT:
+                    self.requeue_stale_jobs()
+                    scanned = monotonic()
+            except pw.PeeweeException as error:
+                logger.warning(f"Unable to synchronize shared state: {error}")
+            await asyncio.sleep(FALLOUT_SYNC_INTERVAL)
+
+    def apply_event(self, payload):
+        try:
+            event = json.loads(payload)
+            model, id, action, data = event["model"], event["id"], event.get("action"), event.get("data") or {}
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Invalid backend event: {payload}")
+            return
+        logger.debug(f"[EVENT] {model} {id} {action} {data}")
+        # A faulty event must not stop the listener from applying the next ones
+        try:
+            self.process_event(model, id, action, data)
+        except Exception as error:
+            logger.error(f"Unable to apply backend event {model} {id} {action}: {error}")
+
+    def process_event(self, model, id, action, data):
+        if model == "campaign":
+            for _channel in [c for c in self.channels.values() if c.campaign_id == id]:
+                if action == "delete":
+                    self.channels.pop(_channel.id, None)
+                elif date := data.get("current_game_date"):
+                    _channel.date = parse_date(date)
+                    _channel.save("date")
+                    _channel.refreshed = monotonic()
+        elif model == "character":
+            creature = self.creatures.get(id)
+            if action == "delete":
+                self.creatures.pop(id, None)
+                if Creature.delete().where(Creature.character_id == id).execute():
+                    store.publish(Creature, id)
+                user_ids = [_user.id for _user in User.select(User.id).where(User.character_id == id)]
+                User.update(character_id=None).where(User.character_id == id).execute()
+                for user_id in user_ids:
+                    store.publish(User, user_id)
+                for _user in self.users.values():
+                    if _user.character_id == id:
+                        _user.character_id = None
+            elif data.get("name"):
+                if Creature.update(name=data["name"]).where(Creature.character_id == id).execute():
+                    store.publish(Creature, id)
+                if creature:
+                    creature.name = data["name"]
+            if action == "delete":
+                self.sheets.pop(id, None)
+            elif sheet := self.sheets.get(id):
+                sheet.update(data)
+
+    async def request(self, endpoint, data=None, method=None, deferred=False, fields=None, strict=False, **options):
         data, method = data or {}, (method or "get").lower()
+        if fields:
+            endpoint += ("&" if "?" in endpoint else "?") + "fields=" + ",".join(fields)
+        # Deferred writes are queued while the backend is down, and behind the ones already queued to keep them ordered
+        if deferred and (self.outage > monotonic() or (self.outbox and not self.outbox.done())):
+            return self.queue_request(endpoint, data, method)
+        if self.outage > monotonic():
+            raise BackendUnavailable("serveur indisponible")
         url = "/".join([FALLOUT_URL, "api", endpoint])
+        if method != "get":
+            self.invalidate_sheets(endpoint)
         func = getattr(self.session, method)
-        if method in ("get", "delete"):
-            resp = await func(url, **options)
-        else:
-            resp = await func(url, json=data, **options)
-        result = ""
+        # Endpoints are limited by class, identifiers and query strings aside
+        key = re.sub(r"\d+", "#", endpoint.partition("?")[0])
+        if key not in self.limiters:
+            self.limiters[key] = Limiter()
+        limiter = self.limiters[key]
+        started, resp = await limiter.acquire(), None
         try:
-            result = resp.json()
-            if resp.status_code < 300:
-                return result
-            return None
-        except:
-            return None
+            if method in ("get", "delete"):
+                resp = await func(url, **options)
+            else:
+                resp = await func(url, json=data, **options)
+        except httpx.TransportError:
+            pass
         finally:
-            logger.debug(f"[{method.upper()}] [{resp.status_code}] {url} {data} {result}")
+            await limiter.release(
+                started, overloaded=resp is None or resp.status_code == 429 or resp.status_code >= 500
+            )
+        if resp is None or resp.status_code in (502, 503, 504):
+            if self.outage < monotonic():
+                logger.warning(f"Backend unavailable, retrying in {FALLOUT_OUTAGE_DELAY}s")
+            self.outage = monotonic() + FALLOUT_OUTAGE_DELAY
+            if deferred:
+                return self.queue_request(endpoint, data, method)
+            raise BackendUnavailable("serveur indisponible")
+        self.outage = 0
+        try:
+            result = json_loads(resp.content)
+        except ValueError:
+            result = None
+        logger.debug(f"[{method.upper()}] [{resp.status_code}] {url} {data} {result}")
+        if self.recorder:
+            self.recorder.request(method, endpoint, resp.status_code, monotonic() - started, result)
+        # Server errors are only told apart from rejected requests when the caller may try again
+        if strict and resp.status_code >= 500:
+            raise BackendError(f"erreur serveur {resp.status_code}")
+        return result if resp.status_code < 300 else None
+
+    async def paginate(self, endpoint, fields=None, page_size=FALLOUT_PAGE_SIZE):
+        # Results are requested one page at a time, as long as the caller keeps iterating
+        separator = "&" if "?" in endpoint else "?"
+        for page in itertools.count(1):
+            ret = await self.request(f"{endpoint}{separator}page={page}&page_size={page_size}", fields=fields)
+            if not ret:
+                return
+            for result in ret["results"]:
+                yield result
+            if not ret.get("next"):
+                return
+
+    async def fetch(self, endpoint, limit, fields=None):
+        results = []
+        async with aclosing(self.paginate(endpoint, fields=fields, page_size=min(limit, FALLOUT_PAGE_SIZE))) as pages:
+            async for result in pages:
+                results.append(result)
+                if len(results) == limit:
+                    break
+        return results
+
+    def queue_request(self, endpoint, data, method):
+        Outbox.create(endpoint=endpoint, method=method, data=json.dumps(data))
+        if not self.outbox or self.outbox.done():
+            self.outbox = asyncio.create_task(self.replay_outbox())
+
+    async def replay_outbox(self):
+        # Queued writes are replayed in order, the first one which cannot be delivered holds the others back
+        while entry := Outbox.select().order_by(Outbox.id).first():
+            await asyncio.sleep(max(self.outage - monotonic(), 0))
+            entry.attempts += 1
+            try:
+                ret = await self.request(entry.endpoint, json.loads(entry.data), entry.method, strict=True)
+            except BackendUnavailable:
+                entry.save(only=[Outbox.attempts])
+                continue
+            except Exception as error:
+                # Transient errors keep the write queued, it is tried again after a while
+                logger.error(f"Queued request failed: [{entry.method.upper()}] {entry.endpoint} ({error})")
+                entry.save(only=[Outbox.attempts])
+                await asyncio.sleep(FALLOUT_OUTAGE_DELAY)
+                continue
+            if ret is None:
+                logger.error(f"Queued request rejected by backend: [{entry.method.upper()}] {entry.endpoint}")
+            Outbox.delete_by_id(entry.id)
 
     def extract_id(self, string):
         groups = re.match(r"<[@!#]+(\d+)>", string)
@@ -1392,11 +3394,21 @@ class Fallout(commands.Cog):
         value = value.strip().lower()
         return enum.get(value, value if default else None)
 
-    def has_role(self, member, target=DISCORD_ADMIN_ROLE):
-        for role in member.roles:
-            if role.name == target:
-                return True
-        return False
+    def has_role(self, member, target=None):
+        target = target or self.get_config(member.guild).admin_role
+        role = self.get_index(member.guild).roles.get(target)
+        return bool(role and member.get_role(role.id))
+
+    def get_index(self, guild):
+        if guild.id not in self.indices:
+            self.indices[guild.id] = GuildIndex(guild)
+        return self.indices[guild.id]
+
+    def get_config(self, guild):
+        if guild.id not in self.configs:
+            instance, created = Guild.get_or_create(id=guild.id, defaults=dict(name=guild.name))
+            self.configs[guild.id] = GuildRecord.load(instance)
+        return self.configs[guild.id]
 
     def get_color(self, code):
         if not code:
@@ -1410,11 +3422,55 @@ class Fallout(commands.Cog):
 
 async def main():
     locale.setlocale(locale.LC_ALL, DISCORD_LOCALE)
-    db.create_tables((Channel, User))
-    bot = commands.Bot(command_prefix=DISCORD_OPERATOR, intents=Intents.all())
-    await bot.add_cog(Fallout(bot))
+    upgrade_database()
+    check_database()
+    options = dict(command_prefix=DISCORD_OPERATOR, intents=Intents.all())
+    if DISCORD_LOW_FOOTPRINT:
+        options.update(
+            intents=Intents(guilds=True, members=True, guild_messages=True, message_content=True),
+            member_cache_flags=MemberCacheFlags.none(),
+            chunk_guilds_at_startup=False,
+        )
+    if DISCORD_SHARDS:
+        # The number of shards is either given or recommended by Discord
+        if DISCORD_SHARDS.isdigit():
+            options.update(shard_count=int(DISCORD_SHARDS))
+        bot = commands.AutoShardedBot(**options)
+    else:
+        bot = commands.Bot(**options)
+    bot.add_cog(Fallout(bot))
     await bot.start(DISCORD_TOKEN)
 
 
+def startup_profile(count=15):
+    # Imports are timed in fresh interpreters so that the report reflects a cold start
+    def importtime(*modules):
+        command = [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"]
+        output = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(__file__) or None).stderr
+        timings = {}
+        for line in output.splitlines():
+            # Only top-level modules and their direct dependencies are reported
+            if match := re.match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)", line):
+                if len(match[2]) <= 2:
+                    timings[match[3]] = int(match[1]) / 1000
+        return timings
+
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    timings = importtime(module)
+    print(f"Startup imports: {timings.pop(module, 0):.1f} ms")
+    for name, elapsed in sorted(timings.items(), key=lambda item: -item[1])[:count]:
+        print(f"  {name:<30} {elapsed:>8.1f} ms")
+    print("Deferred until first use:")
+    for lazy_module in LAZY_MODULES:
+        elapsed = importtime(module, lazy_module.name).get(lazy_module.name, 0)
+        print(f"  {lazy_module.name:<30} {elapsed:>8.1f} ms")
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Bot Discord pour Fallout")
+    parser.add_argument("--startup-profile", action="store_true", help="Affiche le temps d'import des dépendances")
+    args = parser.parse_args()
+    if args.startup_profile:
+        startup_profile()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,101 @@
+# coding: utf-8
+import argparse
+import asyncio
+import gzip
+import json
+import re
+from collections import defaultdict, deque
+from urllib.parse import unquote
+
+from aiohttp import web
+
+
+class Notifier:
+
+    def __init__(self):
+        self.queues = set()
+
+    async def events(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        self.queues.add(queue)
+        try:
+            while True:
+                event = await queue.get()
+                await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        finally:
+            self.queues.discard(queue)
+        return response
+
+    async def notify(self, request):
+        event = await request.json()
+        for queue in self.queues:
+            queue.put_nowait(event)
+        return web.json_response({"listeners": len(self.queues)})
+
+
+def read_trace(path):
+    # A trace cut short when the bot was killed is read up to its last complete record
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                entries.append(json.loads(line))
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            pass
+    return entries
+
+
+class Trace:
+    # Recorded responses are served in order, by endpoint or else by class of endpoint
+    def __init__(self, path, speed=1):
+        self.speed = speed
+        self.responses = defaultdict(deque)
+        for entry in read_trace(path):
+            if entry["type"] == "request":
+                for key in self.keys(entry["method"], entry["endpoint"]):
+                    self.responses[key].append(entry)
+
+    def keys(self, method, endpoint):
+        endpoint = unquote(endpoint)
+        return (method, endpoint), (method, re.sub(r"\d+", "#", endpoint.partition("?")[0]))
+
+    async def handle(self, request):
+        endpoint = str(request.rel_url).removeprefix("/api/")
+        entries = next(filter(None, map(self.responses.get, self.keys(request.method.lower(), endpoint))), None)
+        if not entries:
+            return web.json_response({"detail": "Not recorded."}, status=404)
+        # The last response of an endpoint is served again once the others have been consumed
+        entry = entries.popleft() if len(entries) > 1 else entries[0]
+        await asyncio.sleep(entry["duration"] / self.speed)
+        return web.json_response(entry["response"], status=entry["status"])
+
+
+def application(trace=None):
+    notifier = Notifier()
+    app = web.Application()
+    app.add_routes(
+        [
+            web.get("/api/events/", notifier.events),
+            web.post("/api/notify/", notifier.notify),
+        ]
+    )
+    if trace:
+        app.add_routes([web.route("*", "/api/{endpoint:.*}", trace.handle)])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stub of the Fallout backend")
+    parser.add_argument("--host", default="127.0.0.1", help="Listening address")
+    parser.add_argument("--port", type=int, default=8001, help="Listening port")
+    parser.add_argument("--trace", help="Serve the backend responses recorded in this trace (FALLOUT_RECORD)")
+    parser.add_argument("--speed", type=float, default=1, help="Speed factor applied to recorded latencies")
+    args = parser.parse_args()
+    trace = Trace(args.trace, args.speed) if args.trace else None
+    web.run_app(application(trace), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()